@@ -0,0 +1,80 @@
+# encoding: utf-8
+"""
+响应编码检测的性能测试：对比原来检测整个body和现在先看BOM、<meta charset>，只检测前缀并按网站缓存
+
+运行：python benchmarks/bench_encoding.py
+"""
+import os
+import random
+import sys
+import time
+
+import charset_normalizer
+
+# 添加项目根目录到 Python 路径，不安装hoopa也可以直接运行
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hoopa.utils.encoding import EncodingCache, detect_encoding
+
+# 每个网站的页面数
+PAGES = 5
+# 每个页面的大概字节数
+PAGE_SIZE = 512 * 1024
+
+TEXTS = {
+    "utf-8": "爬虫框架 hoopa 的编码检测，包含中文、日本語とEnglish。",
+    "gbk": "这是一个使用国标编码的中文新闻页面，包含标题、正文和评论。",
+    "shift_jis": "これは日本語のニュースページです。タイトルと本文があります。",
+    "cp1251": "Это русская страница новостей с заголовком и текстом статьи.",
+    "latin-1": "Ceci est une page française avec des caractères accentués: é, è, à, ç.",
+}
+
+
+def make_page(encoding, meta, seed):
+    rng = random.Random(seed)
+    head = f'<meta charset="{encoding}">' if meta else ""
+    rows = []
+    size = 0
+    while size < PAGE_SIZE:
+        row = f"<li><a href='/item/{rng.randint(1, 10 ** 6)}'>{TEXTS[encoding]}</a></li>\n"
+        rows.append(row)
+        size += len(row) * 2
+    return f"<html><head>{head}<title>{encoding}</title></head><body><ul>{''.join(rows)}</ul></body></html>".encode(encoding)
+
+
+def make_corpus():
+    # 每种编码一个网站，只有一半网站有<meta charset>
+    corpus = []
+    for index, encoding in enumerate(TEXTS):
+        for page in range(PAGES):
+            body = make_page(encoding, meta=index % 2 == 0, seed=page)
+            corpus.append((f"https://site{index}.example.com/page/{page}", encoding, body))
+    return corpus
+
+
+def bench(name, detect, corpus):
+    start = time.perf_counter()
+    results = [detect(url, body) for url, _, body in corpus]
+    seconds = time.perf_counter() - start
+    # 解码结果和原文不同的页面数
+    wrong = sum(body.decode(detected, errors="replace") != body.decode(encoding)
+                for (_, encoding, body), detected in zip(corpus, results))
+    print(f"{name:<36}{seconds * 1000:>10.1f} ms{seconds / len(corpus) * 1000:>10.2f} ms/page  wrong: {wrong}")
+    return seconds
+
+
+def main():
+    corpus = make_corpus()
+    size = sum(len(body) for _, _, body in corpus) / 1024 / 1024
+    print(f"{len(corpus)} pages, {size:.1f} MB")
+
+    old = bench("charset_normalizer, full body", lambda url, body: charset_normalizer.detect(body)["encoding"], corpus)
+    bench("bom/meta + prefix, no cache", lambda url, body: detect_encoding(body, url, "text/html", cache=None), corpus)
+    cache = EncodingCache()
+    new = bench("bom/meta + prefix, host cache", lambda url, body: detect_encoding(body, url, "text/html", cache),
+                corpus)
+    print(f"speedup: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# encoding: utf-8
+"""
+请求指纹的性能测试：按Scheduler.add的顺序（去重器get -> 序列化放进队列 -> 去重器add），
+对比原来get、add各计算一次md5指纹和现在只计算一次blake2b指纹
+
+运行：python benchmarks/bench_fingerprint.py
+"""
+import hashlib
+import os
+import sys
+import timeit
+
+# 添加项目根目录到 Python 路径，不安装hoopa也可以直接运行
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hoopa.request import Request
+from hoopa.utils.helpers import request_fingerprint, to_bytes
+
+NUMBER = 20000
+
+
+def md5_fingerprint(request):
+    # 原来的实现
+    fp = hashlib.md5()
+    fp.update(to_bytes(request.method))
+    fp.update(to_bytes(request.request_url))
+    fp.update(to_bytes(str(request.data)) or b'')
+    fp.update(to_bytes(str(request.json)) or b'')
+
+    return fp.hexdigest()
+
+
+def make_requests():
+    return [
+        Request(f"https://example.com/item/{i}?page={i % 10}&sort=desc", params={"q": "hoopa"},
+                json={"id": i, "tags": ["a", "b"], "filter": {"price": [1, 100]}})
+        for i in range(NUMBER)
+    ]
+
+
+def bench(name, func):
+    requests = make_requests()
+    seconds = timeit.timeit(lambda: [func(request) for request in requests], number=1)
+    print(f"{name:<48}{seconds * 1000:>10.1f} ms{seconds / NUMBER * 1e6:>10.2f} us/request")
+    return seconds
+
+
+def old_add(request):
+    # 原来的Scheduler.add：get和add各计算一次指纹
+    fp = md5_fingerprint(request)
+    request.serialize()
+    return fp, md5_fingerprint(request)
+
+
+def reread_add(request):
+    # 序列化读取了params、json，指纹缓存失效，第二次访问重新计算
+    fp = request.fp
+    request.serialize()
+    return fp, request.fp
+
+
+def new_add(request):
+    # 现在的Scheduler.add：指纹只计算一次，get和add共用
+    fp = request.fp
+    request.serialize()
+    return fp, fp
+
+
+def main():
+    bench("serialize only", lambda r: r.serialize())
+    old = bench("md5 (get, serialize, add)", old_add)
+    bench("blake2b, fp read twice (get, serialize, add)", reread_add)
+    new = bench("blake2b, fp once (get, serialize, add)", new_add)
+    bench("md5, uncached", md5_fingerprint)
+    bench("blake2b, uncached", request_fingerprint)
+    print(f"speedup: {old / new:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
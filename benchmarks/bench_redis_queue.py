@@ -0,0 +1,108 @@
+# encoding: utf-8
+"""
+RedisQueue的入队、出队性能测试：对比原来每次EVAL发送整个lua脚本和现在SCRIPT LOAD之后用EVALSHA调用
+
+需要一个运行中的redis（不能用fakeredis代替），默认使用redis://127.0.0.1:6379/15，可以用环境变量REDIS_URL指定，
+测试使用的key会被清空
+运行：python benchmarks/bench_redis_queue.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+import ujson
+
+# 添加项目根目录到 Python 路径，不安装hoopa也可以直接运行
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hoopa.queues import RedisQueue
+from hoopa.request import Request
+from hoopa.utils.scripts import ScriptRegistry
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/15")
+NAME = "hoopa_bench"
+# 每轮入队、出队的request数
+NUMBER = 20000
+# 每次入队的request数，一个回调一般返回几个到几十个request
+ADD_BATCH = 10
+# get_many每次出队的request数，一般为consumer的空闲额度
+GET_BATCH = 100
+
+
+class EvalScriptRegistry(ScriptRegistry):
+    """
+    原来的实现：每次调用都用EVAL发送整个脚本
+    """
+
+    async def load(self, name=None):
+        pass
+
+    async def call(self, name, keys=(), args=()):
+        return await self.pool.eval(self.scripts[name].source, len(keys), *keys, *args)
+
+
+class Engine:
+    requests_count = 0
+    setting = {"REDIS_SETTING": REDIS_URL, "NAME": NAME, "SERIALIZATION": "ujson", "PENDING_THRESHOLD": 100}
+
+
+def make_requests():
+    return [Request(f"https://example.com/item/{i}?page={i % 10}", priority=i % 5) for i in range(NUMBER)]
+
+
+async def timed(name, coro):
+    start = time.perf_counter()
+    await coro
+    seconds = time.perf_counter() - start
+    print(f"{name:<36}{seconds * 1000:>10.1f} ms{NUMBER / seconds:>12.0f} requests/s")
+    return seconds
+
+
+async def push(queue, requests):
+    for i in range(0, len(requests), ADD_BATCH):
+        await queue.add(requests[i:i + ADD_BATCH])
+
+
+async def pop(queue):
+    while await queue.get(None):
+        pass
+
+
+async def pop_many(queue):
+    while await queue.get_many(GET_BATCH, None):
+        pass
+
+
+async def bench(name, queue, requests):
+    await queue.clean_queue()
+    push_seconds = await timed(f"{name}, add x{ADD_BATCH}", push(queue, requests))
+    pop_seconds = await timed(f"{name}, get", pop(queue))
+    await queue.clean_queue()
+    await push(queue, requests)
+    await timed(f"{name}, get_many x{GET_BATCH}", pop_many(queue))
+    await queue.clean_queue()
+    return push_seconds, pop_seconds
+
+
+async def main():
+    queue = await RedisQueue.create(Engine())
+    await queue.init()
+    requests = make_requests()
+    print(f"{NUMBER} requests, {REDIS_URL}")
+
+    scripts = queue.scripts
+    eval_scripts = EvalScriptRegistry(queue.pool)
+    eval_scripts.scripts = scripts.scripts
+
+    queue.scripts = eval_scripts
+    old_push, old_pop = await bench("EVAL", queue, requests)
+    queue.scripts = scripts
+    new_push, new_pop = await bench("EVALSHA", queue, requests)
+    print(f"speedup: add {old_push / new_push:.2f}x, get {old_pop / new_pop:.2f}x")
+
+    await queue.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
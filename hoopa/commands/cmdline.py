@@ -3,6 +3,7 @@ import cProfile
 
 from hoopa.exceptions import UsageError
 from hoopa.commands.create import CreateCommand
+from hoopa.commands.run import RunCommand
 
 
 def _pop_command_name(argv):
@@ -55,7 +56,10 @@ def _print_commands():
     print("Usage:")
     print("  hoopa <command> [options] [args]\n")
     print("Available commands:")
-    cmd_list = {"create": "create project、spider、item and so on"}
+    cmd_list = {
+        "create": "create project、spider、item and so on",
+        "run": "run spider, use -p to run in multiple processes",
+    }
     for cmd_name, cmd_class in sorted(cmd_list.items()):
         print("  %-13s %s" % (cmd_name, cmd_class))
 
@@ -72,7 +76,8 @@ def execute(argv=None):
 
     cmd_name = argv.pop(1)
     cmd_list = {
-        "create": CreateCommand
+        "create": CreateCommand,
+        "run": RunCommand,
     }
 
     if not cmd_name:
@@ -0,0 +1,47 @@
+import argparse
+
+from hoopa.core.supervisor import Supervisor, run_spider
+from hoopa.exceptions import UsageError
+
+
+class RunCommand:
+    parser = None
+
+    def add_arguments(self):
+        parser = argparse.ArgumentParser(description="run spider")
+
+        parser.add_argument("spider_file", help="爬虫文件 如 hoopa run <spider_file>")
+        parser.add_argument(
+            "-c", "--spider-class", default=None, help="爬虫类名，默认为文件中的第一个爬虫类"
+        )
+        parser.add_argument(
+            "-p", "--processes", type=int, default=1,
+            help="进程数，多个进程共享RedisQueue队列 如 hoopa run <spider_file> -p 4"
+        )
+        parser.add_argument(
+            "--max-restarts", type=int, default=3, help="每个进程异常退出后最多重启的次数"
+        )
+        parser.add_argument(
+            "--start-interval", type=float, default=1, help="启动进程的间隔（秒）"
+        )
+
+        self.parser = parser
+
+    def run_cmd(self):
+        args = self.parser.parse_args()
+
+        if args.processes <= 1:
+            run_spider(args.spider_file, args.spider_class)
+            return
+
+        try:
+            supervisor = Supervisor(
+                args.spider_file,
+                class_name=args.spider_class,
+                processes=args.processes,
+                max_restarts=args.max_restarts,
+                start_interval=args.start_interval,
+            )
+        except UsageError as e:
+            self.parser.error(str(e))
+        supervisor.run()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import time
 import traceback
 
 from hoopa.exceptions import Error, InvalidOutput
@@ -82,7 +83,11 @@ class DownloaderMiddleware(MiddlewareManager):
         if not response:
             # 执行完request_middleware，调用下载器
             try:
+                start_time = time.time()
                 response = await run_function(download_func, request)
+                # 记录下载耗时
+                if isinstance(response, Response):
+                    response.elapsed = time.time() - start_time
             except Exception as e:
                 return await self.process_exception(request, Error(e, traceback.format_exc()), spider_ins)
 
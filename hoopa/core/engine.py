@@ -3,24 +3,25 @@
 爬虫核心
 """
 import asyncio
-import inspect
+import functools
 import operator
-import time
 import traceback
 import typing
-from copy import deepcopy
 from signal import SIGINT, SIGTERM
 from types import AsyncGeneratorType, CoroutineType
 
 from loguru import logger
 
 from hoopa.core.downloadermiddleware import DownloaderMiddleware
+from hoopa.core.executor import TaskExecutor
+from hoopa.core.processpool import CallbackProcessPool
 from hoopa.pipelines import PipelineManager
 from hoopa.core.spidermiddleware import SpiderMiddleware
-from hoopa.utils.concurrency import run_function, run_function_no_concurrency, iterate_in_threadpool
+from hoopa.utils.concurrency import run_function, run_function_no_concurrency
 from hoopa.utils.log import Logging
 from hoopa.utils.asynciter import AsyncIter
-from hoopa.utils.helpers import split_list, get_timestamp, load_object, create_instance_and_init
+from hoopa.utils.helpers import split_list, get_timestamp, load_object, create_instance_and_init, \
+    get_retry_delay, get_retry_after
 from hoopa.exceptions import InvalidCallbackResult, Error, InvalidCallback
 from hoopa.item import Item
 from hoopa.request import Request
@@ -46,11 +47,6 @@ class Engine:
         # 循环获取request，默认True
         self.spider.run = True
 
-        self.request_queue: asyncio.Queue = asyncio.Queue()
-
-        # 重试中的个数
-        self.retrying = 0
-
         # 请求数统计
         self.requests_count = 0
 
@@ -78,12 +74,17 @@ class Engine:
         # 初始化stats
         self.stats = self.scheduler.stats
 
+        # 初始化执行器，最多同时执行worker_numbers个任务，任务完成后唤醒consumer
+        self.executor = TaskExecutor(self.spider.worker_numbers, on_done=lambda _: self.scheduler.notify())
+
         # 初始化下载中间件
         self.downloader_middleware = await DownloaderMiddleware.create(self)
         # 初始化爬虫中间件
         self.spider_middleware = await SpiderMiddleware.create(self)
         # 初始化管道
         self.pipeline_manager = await PipelineManager.create(self)
+        # 初始化解析函数进程池
+        self.process_pool = await CallbackProcessPool.create(self)
 
         # 打印配置日志
         self.setting.print_log(self)
@@ -99,13 +100,23 @@ class Engine:
         if not callback_results or response.ok != 1:
             return
 
+        # 解析函数还在运行时，新请求每push_number个批量存储，item逐个交给pipeline处理
         request_list = []
+        # 是否已经有结果存储或者交给pipeline
+        emitted = False
 
         async for callback_result in callback_results:
             if isinstance(callback_result, Request):
                 request_list.append(callback_result)
+                if len(request_list) >= self.spider.push_number:
+                    await self._push_requests(request, request_list)
+                    request_list = []
+                    emitted = True
+                continue
+
+            emitted = True
             # 如果是字典，也可以跟item一样处理
-            elif isinstance(callback_result, dict):
+            if isinstance(callback_result, dict):
                 await self.pipeline_manager.process_pipelines(request, response, callback_result, self.spider)
             # 字典list，也进行处理
             elif isinstance(callback_result, list) and all(isinstance(item, dict) for item in callback_result):
@@ -119,11 +130,19 @@ class Engine:
                 callback_result_name = type(callback_result).__name__
                 raise InvalidCallbackResult(f"<Parse invalid callback result type: {callback_result_name}>")
 
-        # 处理新请求, 默认50个请求批量存储
-        request_list_split = split_list(request_list, 50)
-        for item_requests in request_list_split:
-            count = await self.scheduler.add(item_requests)
-            logger.debug(f"{request} push request {count}")
+        if response.ok == 0:
+            # 解析函数中途出错：还没有输出结果时重试，已经输出部分结果时重试会重复处理，记为失败
+            if not emitted:
+                return
+            response.ok = -1
+            logger.error(f"{request} callback error after partial output, not retrying")
+
+        if request_list:
+            await self._push_requests(request, request_list)
+
+    async def _push_requests(self, request: Request, request_list):
+        count = await self.scheduler.add(request_list)
+        logger.debug(f"{request} push request {count}")
 
     async def _process_callback(self, request, response):
         # 如果response.ok != 1，请求失败，不进行回调
@@ -138,13 +157,13 @@ class Engine:
 
         try:
             if process_func is not None:
-                callback_results = await self.spider_middleware.scrape_response(process_func, request, response,
-                                                                                self.spider)
-                # 判断是否是异步生成器，生成器需要需要在线程池里运行，避免阻塞
-                if callback_results and not inspect.isasyncgen(callback_results):
-                    return iterate_in_threadpool(callback_results)
-                else:
-                    return callback_results
+                # 在进程池执行解析函数
+                if self.process_pool.is_enabled_for(process_func):
+                    process_func = functools.partial(self.process_pool.run_callback, type(self.spider),
+                                                     request.callback)
+
+                # 返回异步生成器，同步生成器在中间件里放到线程池运行
+                return await self.spider_middleware.scrape_response(process_func, request, response, self.spider)
             else:
                 raise Exception(f"<Parse invalid callback result type: {request.callback}>")
         except Exception as e:
@@ -152,7 +171,6 @@ class Engine:
             response.error = Error(e, traceback.format_exc())
             logger.error(f"{request} {response} callback error \n{response.error.stack}")
 
-    @decorators.handle_download_callback_retry()
     async def handle_download_callback(self, request: Request):
         """
         处理请求
@@ -179,21 +197,65 @@ class Engine:
         @param request: request对象
         """
         response = Response()
-        task_request = deepcopy(request)
         try:
-            # 处理请求和回调
-            response = await self.handle_download_callback(task_request)
-            # 处理请求结果
-            await self.scheduler.set_result(request, response, task_request)
-        except Exception as e:
-            response.ok = -1
-            response.error = Error(e, traceback.format_exc())
-            logger.error(f"{request} {response} callback error \n{response.error.stack}")
+            try:
+                # 处理请求和回调，request从队列取出时的序列化结果保存在request.origin，
+                # 所以处理过程中修改request不影响队列中的标识，不需要深拷贝
+                response = await self.handle_download_callback(request)
+                # 重试，放进延迟队列，不占用worker
+                if await self._retry(request, response):
+                    return
+                # 处理请求结果
+                await self.scheduler.set_result(request, response)
+            except Exception as e:
+                response.ok = -1
+                response.error = Error(e, traceback.format_exc())
+                logger.error(f"{request} {response} callback error \n{response.error.stack}")
+                # 记录失败，否则request一直留在pending，爬虫不会结束
+                await self.scheduler.set_result(request, response)
+            finally:
+                # 释放slot
+                await self.scheduler.release(request)
+
+            if response.ok != 1:
+                await run_function(self.spider.process_failed, request, response)
+            else:
+                await run_function(self.spider.process_succeed, request, response)
+        finally:
+            # 请求处理完成（包括重试和出错），释放缓存的解析树
+            response.release()
 
-        if response.ok != 1:
-            await run_function(self.spider.process_failed, task_request, response)
-        else:
-            await run_function(self.spider.process_succeed, task_request, response)
+    async def _retry(self, request: Request, response: Response):
+        """
+        请求失败（response.ok == 0）且未达到最大重试次数时，按退避间隔放进延迟队列
+        @return: 是否重试
+        """
+        if response.ok != 0:
+            return False
+
+        # 重试次数大于等于最大重试次数
+        if request.retries >= request.retry_times:
+            logger.error(f"{request} too many error, try {request.retries} times")
+            response.ok = -1
+            return False
+
+        # 重试次数加1
+        request.retries += 1
+
+        # 统计重试次数
+        stats_name = response.error.name if response.error else response.status
+        await self.stats.inc_value(f"requests/retries/{stats_name}", 1)
+
+        delay = get_retry_delay(
+            request.retries,
+            request.retry_delay,
+            backoff=self.setting["RETRY_BACKOFF"],
+            max_delay=self.setting["RETRY_MAX_DELAY"],
+            jitter=self.setting["RETRY_JITTER"],
+            retry_after=get_retry_after(response.headers),
+        )
+        await self.scheduler.retry(request, delay)
+        return True
 
     async def _handle_start_requests(self):
         """
@@ -217,53 +279,36 @@ class Engine:
             count = await self.scheduler.add(item_requests)
             logger.debug(f"start_requests push request {count}")
 
-    async def start_worker(self):
+    async def consumer(self):
         """
-        Start spider worker
-        :return:
+        事件驱动的consumer：有空闲额度时从队列获取request，队列为空时等待新request入队或者任务完成，
+        当没有等待中、没有进行中的任务时停止
         """
-        while True:
-            request_item = await self.request_queue.get()
-            asyncio.run_coroutine_threadsafe(self._process_task(request_item), loop=self.loop)
-            self.request_queue.task_done()
-
-    async def consumer(self):
         logger.debug(f"consumer started")
-        last_time = time.time()
-        empty_rounds = 0  # 连续空轮次计数
-        max_empty_rounds = 10  # 最大空轮次，超过后退出
-        
+        idle_timeout = self.setting["SCHEDULER_IDLE_TIMEOUT"]
+
         while self.spider.run:
-            qsize = self.request_queue.qsize()
-            add_task_count = max(self.spider.worker_numbers - qsize - self.retrying, 0)
-            # logger.error(f"add_task_count: {add_task_count} {qsize} {self.retrying}")
-            add_task_count = min(add_task_count, self.spider.worker_numbers)
-            
-            added_requests = 0
-            for _ in range(add_task_count):
-                request_item = await self.scheduler.get(self.spider.priority)
-                if request_item is None:
-                    break
-                self.request_queue.put_nowait(request_item)
-                added_requests += 1
-
-            # 如果没有添加任何请求，增加空轮次计数
-            if added_requests == 0:
-                empty_rounds += 1
-                # 如果连续多轮都没有新请求，且队列为空，则退出
-                if empty_rounds >= max_empty_rounds and qsize == 0:
+            # 没有空闲额度，等待任务完成
+            if self.executor.full:
+                await self.scheduler.wait()
+                continue
+
+            # 本地取完后按空闲额度从队列批量获取，减少访问队列的次数
+            request_item = await self.scheduler.get(self.spider.priority, self.executor.available)
+            if request_item is not None:
+                self.executor.spawn(self._process_task(request_item))
+                continue
+
+            # 队列为空且没有进行中的任务，检查队列状态，判断是否结束
+            if self.executor.idle:
+                await self.scheduler.check_scheduler(self.spider)
+                if not self.spider.run:
                     logger.debug("No more requests available, consumer stopping")
                     break
-            else:
-                empty_rounds = 0  # 重置空轮次计数
 
-            # 休眠
-            sleep_second = max(self.spider.download_delay - (time.time() - last_time), 0.01)
+            # 等待新的request入队或者任务完成
+            await self.scheduler.wait(idle_timeout)
 
-            await asyncio.sleep(sleep_second)
-            last_time = time.time()
-            await self.scheduler.check_scheduler(self.spider)
-            
         logger.debug("Consumer finished")
 
     async def _start_spider(self):
@@ -276,31 +321,12 @@ class Engine:
         if self.spider.run:
             logger.info(f"Spider start")
 
-        # 启动worker任务
-        workers = [
-            asyncio.ensure_future(self.start_worker())
-            for _ in range(self.spider.worker_numbers * 3)
-        ]
-
-        logger.debug(f"Worker started: {len(workers)}")
-
-        # 启动consumer任务
-        consumer_task = asyncio.ensure_future(self.consumer())
-
         try:
             # 等待consumer完成（当没有更多请求时会自动退出）
-            await consumer_task
-            
-            # 等待所有队列中的任务完成
-            await self.request_queue.join()
-            
+            await self.consumer()
         finally:
-            # 取消所有worker任务
-            for worker in workers:
-                worker.cancel()
-            
-            # 等待所有worker任务完成取消
-            await asyncio.gather(*workers, return_exceptions=True)
+            # 等待进行中的任务完成，超时后取消
+            await self.executor.close(self.setting["SHUTDOWN_TIMEOUT"])
 
         await self.finish()
 
@@ -371,6 +397,7 @@ class Engine:
         await run_function_no_concurrency(self.downloader_middleware.close)
         await run_function_no_concurrency(self.spider_middleware.close)
         await run_function_no_concurrency(self.pipeline_manager.close)
+        await run_function(self.process_pool.close)
         await self.cancel_all_tasks()
 
     async def cancel_all_tasks(self, _signal=None):
@@ -0,0 +1,87 @@
+# encoding: utf-8
+"""
+任务执行器
+"""
+import asyncio
+import typing
+
+from loguru import logger
+
+
+class TaskExecutor:
+    """
+    有并发上限的任务执行器，记录所有进行中的任务，关闭时等待任务完成
+    """
+
+    def __init__(self, limit, on_done: typing.Callable = None):
+        """
+        @param limit: 最大并发数
+        @param on_done: 任务完成后的回调，参数为task
+        """
+        self.limit = limit
+        self.on_done = on_done
+        self.tasks: typing.Set[asyncio.Task] = set()
+
+    @property
+    def running(self):
+        return len(self.tasks)
+
+    @property
+    def full(self):
+        return len(self.tasks) >= self.limit
+
+    @property
+    def available(self):
+        """
+        空闲额度
+        """
+        return max(self.limit - len(self.tasks), 0)
+
+    @property
+    def idle(self):
+        return not self.tasks
+
+    def spawn(self, coro):
+        """
+        启动一个任务，调用前需要判断是否还有空闲额度
+        @param coro: 协程
+        @return: task
+        """
+        if self.full:
+            coro.close()
+            raise RuntimeError(f"executor is full, limit: {self.limit}")
+
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"task error: {task.exception()!r}")
+        if self.on_done:
+            self.on_done(task)
+
+    async def join(self, timeout=None):
+        """
+        等待所有进行中的任务完成
+        @param timeout: 超时时间，None一直等待
+        @return: 超时后未完成的任务
+        """
+        if not self.tasks:
+            return set()
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        return pending
+
+    async def close(self, timeout=None):
+        """
+        关闭执行器：等待进行中的任务完成，超时后取消剩余任务
+        @param timeout: 超时时间，None一直等待
+        """
+        pending = await self.join(timeout)
+        if pending:
+            logger.warning(f"cancel {len(pending)} unfinished tasks")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
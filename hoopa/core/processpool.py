@@ -0,0 +1,99 @@
+# encoding: utf-8
+"""
+进程池：在子进程执行解析函数，绕过GIL，适合lxml/parsel等cpu密集的解析
+"""
+import asyncio
+import inspect
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from multidict import CIMultiDict
+
+from hoopa.request import Request
+from hoopa.response import Response
+
+# 子进程中缓存的spider实例，key为spider类
+_spiders = {}
+
+
+def _get_spider(spider_cls):
+    spider_ins = _spiders.get(spider_cls)
+    if spider_ins is None:
+        spider_ins = spider_cls()
+        _spiders[spider_cls] = spider_ins
+    return spider_ins
+
+
+async def _collect_async(results):
+    return [result async for result in results]
+
+
+def run_callback(spider_cls, callback, request_str, response_kwargs):
+    """
+    在子进程执行解析函数，返回解析函数生成的Request、Item、字典的列表
+    @param spider_cls: 爬虫类，按引用序列化，子进程中新建实例
+    @param callback: 解析函数名称
+    @param request_str: pickle序列化的request
+    @param response_kwargs: 构造Response的参数
+    """
+    spider_ins = _get_spider(spider_cls)
+    request = Request.unserialize(request_str, pickle)
+    response = Response(**response_kwargs)
+
+    results = getattr(spider_ins, callback)(request, response)
+    if inspect.iscoroutine(results):
+        results = asyncio.run(results)
+    if inspect.isasyncgen(results):
+        results = asyncio.run(_collect_async(results))
+    if results is None:
+        return []
+    if isinstance(results, (Request, dict)) or not hasattr(results, "__iter__"):
+        return [results]
+    return list(results)
+
+
+class CallbackProcessPool:
+    """
+    解析函数进程池，PROCESS_POOL为True时所有解析函数都在进程池执行，
+    否则只执行被decorators.run_in_process装饰的解析函数。
+    子进程中的spider是新建的实例，不能使用open_spider、init中初始化的属性
+    """
+
+    def __init__(self, enabled=False, max_workers=None):
+        self.enabled = enabled
+        self.max_workers = max_workers
+        self.executor = None
+
+    @classmethod
+    async def create(cls, engine):
+        return cls(engine.setting.get("PROCESS_POOL", False), engine.setting.get("PROCESS_POOL_WORKERS"))
+
+    def is_enabled_for(self, func):
+        return self.enabled or getattr(func, "run_in_process", False)
+
+    @staticmethod
+    def dump_response(response: Response):
+        headers = CIMultiDict(response.headers.items()) if response.headers else None
+        return {
+            "url": response.url,
+            "status": response.status,
+            # 写到临时文件的响应内容是mmap，不能pickle
+            "body": response.body if isinstance(response.body, bytes) else bytes(response.body),
+            "headers": headers,
+            "encoding": response.encoding,
+        }
+
+    async def run_callback(self, spider_cls, callback, request: Request, response: Response):
+        """
+        把request和response发送到子进程执行解析函数
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.max_workers)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, run_callback, spider_cls, callback,
+                                          request.serialize(pickle), self.dump_response(response))
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
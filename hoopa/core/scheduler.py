@@ -3,16 +3,21 @@
 调度器
 """
 
+import asyncio
 import time
 import typing
+from collections import deque
 
 from loguru import logger
 from w3lib.url import is_url
 
+from hoopa.core.slot import SlotManager
 from hoopa.exceptions import InvalidUrl
 from hoopa.request import Request
 from hoopa.response import Response
+from hoopa.utils.connection import get_aio_redis
 from hoopa.utils.helpers import get_timestamp, load_object, create_instance_and_init
+from hoopa.utils.ratelimit import bucket_factory
 
 
 class Scheduler:
@@ -25,7 +30,21 @@ class Scheduler:
         self.stats = stats
         self.engine = engine
 
+        # 按域名划分的并发和间隔控制
+        self.slots = SlotManager.from_setting(engine.setting) if engine else SlotManager()
+        # 全局令牌桶，None不限速
+        self.bucket = None
+        self._redis_pool = None
+        # 从队列批量取出、还没有分发的request
+        self._buffer = deque()
+
         self._last_check_status_time = time.time()
+        # 暂存的request（_buffer和slot中）每lease_interval秒续租一次，PENDING_THRESHOLD的三分之一
+        self.lease_interval = engine.setting["PENDING_THRESHOLD"] / 3 if engine else None
+        self._last_renew_time = time.time()
+
+        # 唤醒事件：有新的request入队或者有任务完成时触发，consumer等待这个事件而不是轮询
+        self._wakeup = asyncio.Event()
 
     @classmethod
     async def create(cls, engine):
@@ -54,21 +73,74 @@ class Scheduler:
         # 初始化爬虫开始时间
         await self.stats.min_value("start_time", int(get_timestamp()))
 
-    async def get(self, priority=None):
+        await self._init_rate_limit()
+
+    async def _init_rate_limit(self):
+        """
+        创建令牌桶，RATE_LIMIT为None时按 每download_delay秒worker_numbers个 计算每秒请求数
+        """
+        setting = self.engine.setting
+        spider = self.engine.spider
+
+        if setting.get("RATE_LIMIT_REDIS"):
+            self._redis_pool = await get_aio_redis(setting["REDIS_SETTING"])
+            self.slots.bucket_factory = bucket_factory(self._redis_pool, f"{setting['NAME']}:ratelimit")
+
+        rate = setting.get("RATE_LIMIT")
+        if rate is None:
+            download_delay = spider.download_delay or 0
+            # 间隔可以是两个数组成的list，取平均值
+            if isinstance(download_delay, (list, tuple)):
+                download_delay = sum(download_delay) / len(download_delay)
+            rate = spider.worker_numbers / download_delay if download_delay else 0
+
+        if rate:
+            burst = setting.get("RATE_LIMIT_BURST") or spider.worker_numbers
+            self.bucket = self.slots.bucket_factory("global", rate, burst)
+
+    async def get(self, priority=None, count=1):
         """
         从队列中获取一个 request
         @param priority: 权重，取出对应权重的request，当队列为redis时生效
+        @param count: 本地没有取出的request时，一次从队列批量获取的数量，一般为consumer的空闲额度
         """
         if priority and not isinstance(priority, (int, list)):
             raise TypeError(f"queue_priority must be int or list, not {type(priority)}")
 
-        request = await self.scheduler_queue.get(priority)
+        await self.renew_lease()
+
+        # 优先从暂存的request中获取slot已空闲的request
+        request = await self.slots.pop_ready()
+
+        # slot没有空闲的request先暂存，继续从队列获取，直到暂存数达到上限
+        while request is None and not self.slots.full:
+            if not self._buffer:
+                requests = await self.scheduler_queue.get_many(max(count, 1), priority)
+                if not requests:
+                    break
+                self._buffer.extend(requests)
+                await self.stats.inc_value('queue/request_count', len(requests))
+
+            request = self._buffer.popleft()
+            if not await self.slots.is_ready(request):
+                await self.slots.park(request)
+                request = None
 
         if request:
-            await self.stats.inc_value('queue/request_count', 1)
+            # 全局限速，等待令牌
+            if self.bucket:
+                await self.bucket.acquire()
+            await self.slots.acquire(request)
             logger.debug(f"get request {request}")
         return request
 
+    async def release(self, request: Request):
+        """
+        request处理完成，释放slot
+        @param request:
+        """
+        await self.slots.release(request)
+
     async def add(self, requests: typing.Union[Request, typing.List[Request]]):
         """
         向队列添加多个request
@@ -87,14 +159,18 @@ class Scheduler:
         request_stats = {}
         # 去重
         request_list = []
+        # 新request的指纹，放进队列后加入去重器；序列化会读取params等字段使缓存失效，所以只计算一次
+        fp_list = []
         for request in requests:
             if request.dont_filter:
                 request_stats[request.priority] = request_stats.get(request.priority, 0) + 1
                 request_list.append(request)
             else:
-                if await self.dupefilter.get(request.fp):
+                fp = self.get_fp(request)
+                if await self.dupefilter.get(fp):
                     request_stats[request.priority] = request_stats.get(request.priority, 0) + 1
                     request_list.append(request)
+                    fp_list.append(fp)
         #  去重后为空
         if not request_list:
             return 0
@@ -103,9 +179,12 @@ class Scheduler:
         set_len = await self.scheduler_queue.add(request_list)
 
         # 把放进队列的request去重
-        for request in requests:
-            if not request.dont_filter:
-                await self.dupefilter.add(request.fp)
+        for fp in fp_list:
+            await self.dupefilter.add(fp)
+
+        # 有新请求，唤醒等待中的consumer
+        if set_len:
+            self.notify()
 
         # 统计，统计去重数（待定）
         # 统计request
@@ -114,14 +193,19 @@ class Scheduler:
 
         return set_len
 
-    async def set_result(self, request: Request, response: Response, task_request: Request):
+    def get_fp(self, request: Request):
+        """
+        去重器使用的指纹
+        """
+        return request.fp_bytes if self.dupefilter.binary_fp else request.fp
+
+    async def set_result(self, request: Request, response: Response):
         """
         保存结果
-        @param request:
+        @param request: 爬虫请求过程中的request，队列通过request.origin找到取出时的request
         @param response:
-        @param task_request: 爬虫请求过程中的request
         """
-        await self.scheduler_queue.set_result(request, response, task_request)
+        await self.scheduler_queue.set_result(request, response)
 
         if response.ok == 1:
             logger.debug(f"{request} result: success, status: {response.status}")
@@ -132,6 +216,65 @@ class Scheduler:
         await self.stats.inc_value(f"queue/response_count", 1)
         await self.stats.inc_value(f'queue/response_count/priority_{request.priority}/{response.ok}', 1)
 
+    async def retry(self, request: Request, delay):
+        """
+        重试，放进延迟队列，delay秒后重新分发
+        @param request:
+        @param delay: 延迟秒数
+        """
+        await self.scheduler_queue.retry(request, delay)
+        logger.debug(f"{request} retry {request.retries} times after {delay:.2f}s")
+
+    async def renew_lease(self):
+        """
+        延长从队列取出、还暂存在本地的request的租约，租约到期前没有分发的request会被其他consumer重复抓取
+        """
+        if not self.lease_interval or time.time() - self._last_renew_time < self.lease_interval:
+            return
+        self._last_renew_time = time.time()
+
+        requests = [*self._buffer, *self.slots.parked_requests()]
+        if requests:
+            await self.scheduler_queue.renew(requests)
+            logger.debug(f"renew lease: {len(requests)}")
+
+    def _renew_in(self):
+        """
+        下次续租的秒数，没有暂存的request时返回None
+        """
+        if not self.lease_interval or not (self._buffer or self.slots.parked):
+            return None
+        return max(self._last_renew_time + self.lease_interval - time.time(), 0)
+
+    def notify(self):
+        """
+        唤醒等待中的consumer
+        """
+        self._wakeup.set()
+
+    async def wait(self, timeout=None):
+        """
+        等待唤醒事件，超时后返回，用于兜底其他进程往队列添加的request
+        @param timeout: 超时时间，None一直等待
+        @return: 是否被唤醒
+        """
+        # 有暂存的request在等待slot的请求间隔、需要续租，或者延迟队列中的request到期，到时间后唤醒
+        for ready_in in (self.slots.next_ready_in(), self.scheduler_queue.next_retry_in(), self._renew_in()):
+            if ready_in is not None:
+                timeout = ready_in if timeout is None else min(timeout, ready_in)
+
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+            woken = True
+        except asyncio.TimeoutError:
+            woken = False
+        finally:
+            self._wakeup.clear()
+
+        # 并发数满的时候consumer不调用get，在这里续租
+        await self.renew_lease()
+        return woken
+
     async def check_scheduler(self, spider_ins):
         await self.scheduler_queue.check_status(spider_ins, self.engine.spider.setting["RUN_FOREVER"])
 
@@ -142,3 +285,5 @@ class Scheduler:
         await self.dupefilter.close()
         await self.scheduler_queue.close()
         await self.stats.close()
+        if self._redis_pool:
+            await self._redis_pool.aclose()
@@ -0,0 +1,245 @@
+# encoding: utf-8
+"""
+slot：按域名（或ip）划分的并发、请求间隔和速率控制
+"""
+import asyncio
+import socket
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+from loguru import logger
+
+from hoopa.request import Request
+from hoopa.utils.ratelimit import bucket_factory
+
+
+class Slot:
+    def __init__(self, concurrency=0, delay=0, bucket=None):
+        # 最大并发数，0不限制
+        self.concurrency = concurrency
+        # 两次请求的最小间隔
+        self.delay = delay
+        # 令牌桶，限制每秒请求数
+        self.bucket = bucket
+        # 令牌桶没有令牌时，暂停到这个时间
+        self.blocked_until = 0
+        # 进行中的请求数
+        self.active = 0
+        # 最后一次分发请求的时间
+        self.last_seen = 0
+        # 等待slot空闲的request
+        self.queue = deque()
+        # 下载延迟的指数移动平均值和最小值，自动限速时使用
+        self.latency = None
+        self.min_latency = None
+
+    @property
+    def free(self):
+        return not self.concurrency or self.active < self.concurrency
+
+    def ready_in(self, now=None):
+        """
+        距离可以分发下一个请求的秒数，0表示有空闲额度且已过了间隔
+        """
+        if not self.free:
+            return None
+        if not self.delay and not self.blocked_until:
+            return 0
+        now = now or time.time()
+        return max(self.delay - (now - self.last_seen), self.blocked_until - now, 0)
+
+    def __repr__(self):
+        return f"<Slot active={self.active} concurrency={self.concurrency} delay={self.delay} queue={len(self.queue)}>"
+
+
+class SlotManager:
+    """
+    管理所有的slot，request的meta可以设置：
+    - slot: 指定slot名称，默认为域名（SLOT_BY_IP为True时为ip）
+    - slot_concurrency: slot的最大并发数，默认DOMAIN_CONCURRENCY
+    - slot_delay: slot的请求间隔，默认DOMAIN_DELAY
+    - slot_rate: slot每秒请求数，默认DOMAIN_RATE_LIMIT
+    """
+
+    def __init__(self, concurrency=0, delay=0, backlog=1000, by_ip=False, rate=0, burst=1, priority_rates=None):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.backlog = backlog
+        self.by_ip = by_ip
+        # 每个slot的每秒请求数和令牌桶容量，0不限制
+        self.rate = rate
+        self.burst = burst
+        # 按优先级限速，{优先级: 每秒请求数}
+        self.priority_rates = priority_rates or {}
+        # 创建令牌桶的函数，多机共享速率时替换为redis令牌桶
+        self.bucket_factory = bucket_factory()
+
+        self.slots = {}
+        self.priority_buckets = {}
+        # 暂存的request数
+        self.parked = 0
+        # 域名解析的缓存
+        self._ip_cache = {}
+        self._last_gc_time = time.time()
+
+    @classmethod
+    def from_setting(cls, setting):
+        return cls(
+            concurrency=setting.get("DOMAIN_CONCURRENCY") or 0,
+            delay=setting.get("DOMAIN_DELAY") or 0,
+            backlog=setting.get("DOMAIN_BACKLOG") or 0,
+            by_ip=setting.get("SLOT_BY_IP") or False,
+            rate=setting.get("DOMAIN_RATE_LIMIT") or 0,
+            burst=setting.get("DOMAIN_RATE_BURST") or 1,
+            priority_rates=setting.get("PRIORITY_RATE_LIMIT") or {},
+        )
+
+    async def get_key(self, request: Request):
+        meta = request.meta or {}
+        if meta.get("slot"):
+            return meta["slot"]
+
+        host = urlparse(request.url).hostname or ""
+        if not self.by_ip:
+            return host
+
+        if host not in self._ip_cache:
+            try:
+                loop = asyncio.get_running_loop()
+                info = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+                self._ip_cache[host] = info[0][4][0]
+            except (OSError, IndexError):
+                logger.debug(f"resolve {host} error, use host as slot")
+                self._ip_cache[host] = host
+        return self._ip_cache[host]
+
+    async def get_slot(self, request: Request):
+        key = await self.get_key(request)
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = Slot(self.concurrency, self.delay)
+            if self.rate:
+                slot.bucket = self.bucket_factory(f"slot:{key}", self.rate, self.burst)
+            self.slots[key] = slot
+
+        meta = request.meta or {}
+        if meta.get("slot_concurrency") is not None:
+            slot.concurrency = meta["slot_concurrency"]
+        if meta.get("slot_delay") is not None:
+            slot.delay = meta["slot_delay"]
+        if meta.get("slot_rate") and (slot.bucket is None or slot.bucket.rate != meta["slot_rate"]):
+            slot.bucket = self.bucket_factory(f"slot:{key}", meta["slot_rate"], self.burst)
+        return slot
+
+    def get_priority_bucket(self, priority):
+        rate = self.priority_rates.get(priority)
+        if not rate:
+            return None
+
+        bucket = self.priority_buckets.get(priority)
+        if bucket is None:
+            bucket = self.bucket_factory(f"priority:{priority}", rate)
+            self.priority_buckets[priority] = bucket
+        return bucket
+
+    @property
+    def full(self):
+        return bool(self.backlog) and self.parked >= self.backlog
+
+    async def is_ready(self, request: Request):
+        slot = await self.get_slot(request)
+        return await self._take_token(slot, request)
+
+    async def _take_token(self, slot, request: Request, now=None):
+        """
+        slot空闲时从域名和优先级的令牌桶取令牌，没有令牌时slot暂停到有令牌为止。
+        两个令牌桶都有令牌时才消耗，避免只消耗其中一个
+        """
+        now = now or time.time()
+        if slot.ready_in(now) != 0:
+            return False
+
+        buckets = [bucket for bucket in (slot.bucket, self.get_priority_bucket(request.priority)) if bucket]
+        for bucket in buckets:
+            wait = await bucket.wait_time()
+            if wait:
+                slot.blocked_until = now + wait
+                return False
+
+        for index, bucket in enumerate(buckets):
+            wait = await bucket.consume()
+            if wait:
+                # 检查之后被其他进程取走了令牌（redis令牌桶），已经消耗的令牌放回去
+                for consumed in buckets[:index]:
+                    await consumed.refund()
+                slot.blocked_until = now + wait
+                return False
+
+        slot.blocked_until = 0
+        return True
+
+    async def park(self, request: Request):
+        """
+        暂存slot没有空闲的request
+        """
+        slot = await self.get_slot(request)
+        slot.queue.append(request)
+        self.parked += 1
+
+    async def pop_ready(self):
+        """
+        从暂存的request中取出一个slot已空闲的request
+        """
+        if not self.parked:
+            return None
+
+        now = time.time()
+        for slot in list(self.slots.values()):
+            if slot.queue and await self._take_token(slot, slot.queue[0], now):
+                self.parked -= 1
+                return slot.queue.popleft()
+        return None
+
+    def parked_requests(self):
+        """
+        所有暂存的request
+        """
+        for slot in self.slots.values():
+            yield from slot.queue
+
+    def next_ready_in(self):
+        """
+        暂存的request中最快可以分发的秒数，没有暂存或者都在等待并发额度时返回None
+        """
+        if not self.parked:
+            return None
+
+        now = time.time()
+        ready_in_list = [slot.ready_in(now) for slot in self.slots.values() if slot.queue]
+        ready_in_list = [_ for _ in ready_in_list if _ is not None]
+        return min(ready_in_list) if ready_in_list else None
+
+    async def acquire(self, request: Request):
+        slot = await self.get_slot(request)
+        slot.active += 1
+        slot.last_seen = time.time()
+
+    async def release(self, request: Request):
+        slot = await self.get_slot(request)
+        slot.active = max(slot.active - 1, 0)
+        self._gc()
+
+    def _gc(self, interval=60):
+        """
+        定期删除空闲的slot，避免域名太多时占用内存
+        """
+        now = time.time()
+        if now - self._last_gc_time < interval:
+            return
+        self._last_gc_time = now
+
+        for key in list(self.slots):
+            slot = self.slots[key]
+            if not slot.active and not slot.queue and now - slot.last_seen > max(slot.delay, interval):
+                self.slots.pop(key)
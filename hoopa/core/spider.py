@@ -36,11 +36,19 @@ class BaseSpider:
     - name: 爬虫名称.
     - worker_numbers: worker_numbers任务数，每download_delay秒worker_numbers个， 默认每1秒1个
     - download_delay: 爬虫请求间隔，每download_delay秒worker_numbers个， 默认每1秒1个
+    - domain_concurrency: 每个域名的最大并发数，默认0不限制
+    - domain_delay: 每个域名两次请求的最小间隔，默认0不限制
+    - rate_limit: 全局每秒请求数，默认为 worker_numbers / download_delay
+    - domain_rate_limit: 每个域名每秒请求数，默认0不限制
     - pending_threshold: pending超时时间.
     - run_forever: 任务完成不停止, 默认False.
     - queue_cls: 任务队列路径，默认：const.MemoryQueue(hoopa.queues.MemoryQueue).
     - clean_queue: 清空任务队列，默认False.
     - priority: 指定队列优先级，redis优先队列有效.
+    - mq_uri: RabbitMQQueue的连接uri
+    - mq_maxsize: RabbitMQQueue发布消息的channel池大小，默认10
+    - mq_max_priority: RabbitMQQueue的最大优先级，默认10
+    - mq_prefetch: RabbitMQQueue预取的消息数，默认等于worker_numbers
     - downloader_cls: 下载器路径，默认：const.AiohttpDownloader(hoopa.downloader.AiohttpDownloader).
     - downloader_middlewares: 下载中间件
     - spider_middlewares: 爬虫中间件
@@ -50,6 +58,7 @@ class BaseSpider:
     - dupefilter_setting: 去重器设置，默认等于redis_setting
     - redis_setting: redis连接配置，可以是字典，也可以是uri 例如："redis://127.0.0.1:6379/0?encoding=utf-8"
     - serialization: 序列化模块，默认ujson，可选pickle
+    - queue_compression: redis队列中request的压缩方式，默认None不压缩，可选zlib、zstd
     - log_config： 自定义logger.configure的参数，类型为字典
     - log_level： 日志级别，默认INFO
     - log_write_file： 日志是否写入文件，默认否
@@ -58,16 +67,25 @@ class BaseSpider:
     - interrupt_with_error： 出现错误时推出，默认False
     - failure_to_waiting：  将错误队列放入等待队列，默认False
     - push_number：  请求推送到redis单次最大数量
+    - process_pool:  解析函数在进程池执行，默认False
     - run:  控制爬虫停止，默认为True运行，设置为False停止
     """
     name: str = "hoopa"
     worker_numbers: int = None
     download_delay: int = None
+    domain_concurrency: int = None
+    domain_delay: float = None
+    rate_limit: float = None
+    domain_rate_limit: float = None
     pending_threshold: int = None
     run_forever: bool = None
     queue_cls: str = None
     clean_queue: bool = None
     priority: int = None
+    mq_uri: str = None
+    mq_maxsize: int = None
+    mq_max_priority: int = None
+    mq_prefetch: int = None
     downloader_cls: str = None
     http_client_kwargs: bool = None
     downloader_middlewares: list = None
@@ -82,12 +100,14 @@ class BaseSpider:
     log_level: str = None
     log_write_file: bool = None
     serialization: bool = None
+    queue_compression: str = None
     settings_path: str = "config.settings"
     start_urls: list = []
     interrupt_with_error: bool = None
     setting: Setting = None
     push_number: int = None
     failure_to_waiting: bool = None
+    process_pool: bool = None
     run: bool = None
 
     async def run_spider_hook(self, hook_func):
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import inspect
 import traceback
 
 from hoopa.item import Item
@@ -6,11 +7,13 @@ from hoopa.exceptions import Error, InvalidOutput
 from hoopa.middleware import MiddlewareManager
 from hoopa.request import Request
 from hoopa.response import Response
-from hoopa.utils.concurrency import run_function
+from hoopa.utils.concurrency import run_function, iterate_in_threadpool, iterate_async
 
 
 class SpiderMiddleware(MiddlewareManager):
     """爬虫中间件"""
+    # 同步生成器每次在线程池取出的结果数
+    chunk_size = 20
 
     @classmethod
     def _get_mw_list_from_engine(cls, engine):
@@ -65,21 +68,36 @@ class SpiderMiddleware(MiddlewareManager):
         raise error.exception
 
     async def scrape_response(self, parse_func, request, response, spider_ins):
+        """
+        调用解析函数，返回异步生成器，解析结果在迭代时才经过process_output，不会先把所有结果放在列表里
+        """
         # 调用中间件
         await self.process_input(request, response, spider_ins)
 
         try:
             results = await run_function(parse_func, request, response)
+        except Exception as e:
+            await self.process_exception(request, response, Error(e, traceback.format_exc()), spider_ins)
+            return None
 
-            if results:
-                # 加载response中间件
-                process_response_results = []
-                for result in results:
-                    process_response_result = await self.process_output(request, response, result, spider_ins)
-                    process_response_results.append(process_response_result)
+        if not results:
+            return None
 
-                return iter(process_response_results)
+        return self._iter_output(results, request, response, spider_ins)
+
+    async def _iter_output(self, results, request, response, spider_ins):
+        try:
+            if inspect.isasyncgen(results):
+                iterator = results
+            elif inspect.isgenerator(results):
+                # 同步生成器在线程池里运行，避免阻塞
+                iterator = iterate_in_threadpool(results, self.chunk_size)
+            else:
+                iterator = iterate_async(results)
+
+            async for result in iterator:
+                # 加载response中间件
+                yield await self.process_output(request, response, result, spider_ins)
 
         except Exception as e:
             await self.process_exception(request, response, Error(e, traceback.format_exc()), spider_ins)
-
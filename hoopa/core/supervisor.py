@@ -0,0 +1,187 @@
+# encoding: utf-8
+"""
+多进程运行爬虫：启动多个进程运行同一个爬虫，共享RedisQueue队列，进程异常退出时重启，汇总各进程的统计
+"""
+import asyncio
+import importlib.util
+import inspect
+import multiprocessing
+import os
+import signal
+import time
+
+import ujson
+from loguru import logger
+
+from hoopa.exceptions import UsageError
+from hoopa.settings import const
+from hoopa.utils.connection import get_aio_redis
+from hoopa.utils.helpers import get_mac_address
+from hoopa.utils.project import get_project_settings
+
+
+def load_spider_cls(spider_file, class_name=None):
+    """
+    从爬虫文件加载爬虫类
+    @param spider_file: 爬虫文件路径
+    @param class_name: 爬虫类名，为空时取文件中定义的第一个爬虫类
+    """
+    from hoopa.core.spider import BaseSpider
+
+    module_name = os.path.splitext(os.path.basename(spider_file))[0]
+    module_spec = importlib.util.spec_from_file_location(module_name, spider_file)
+    if module_spec is None:
+        raise UsageError(f"Unable to load spider file: {spider_file}")
+
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+
+    if class_name:
+        spider_cls = getattr(module, class_name, None)
+        if spider_cls is None:
+            raise UsageError(f"{spider_file} doesn't define any spider named '{class_name}'")
+        return spider_cls
+
+    for _, obj in inspect.getmembers(module, inspect.isclass):
+        if issubclass(obj, BaseSpider) and obj.__module__ == module.__name__:
+            return obj
+
+    raise UsageError(f"{spider_file} doesn't define any spider")
+
+
+def run_spider(spider_file, class_name=None, clean=True):
+    """
+    子进程入口
+    @param spider_file: 爬虫文件路径
+    @param class_name: 爬虫类名
+    @param clean: 是否按配置清空队列，只有第一个进程第一次启动时清空
+    """
+    spider_cls = load_spider_cls(spider_file, class_name)
+    if not clean:
+        spider_cls.clean_queue = False
+        spider_cls.clean_dupefilter = False
+    spider_cls.start()
+
+
+class Supervisor:
+    """
+    多进程爬虫的管理进程
+    """
+
+    def __init__(self, spider_file, class_name=None, processes=1, max_restarts=3, start_interval=1,
+                 heart_beat_interval=10):
+        self.spider_file = spider_file
+        self.class_name = class_name
+        self.processes = processes
+        self.max_restarts = max_restarts
+        self.start_interval = start_interval
+        self.heart_beat_interval = heart_beat_interval
+
+        spider_cls = load_spider_cls(spider_file, class_name)
+        self.setting = get_project_settings(spider_cls.settings_path)
+        self.setting.init_settings(spider_cls())
+
+        if self.processes > 1 and self.setting["QUEUE_CLS"] != const.RedisQueue:
+            raise UsageError("multiple processes need a shared queue, set queue_cls = const.RedisQueue")
+
+        self.workers = {}
+        self.restarts = {}
+        self.running = True
+
+    def _start_worker(self, index, clean):
+        process = multiprocessing.Process(
+            target=run_spider,
+            args=(self.spider_file, self.class_name, clean),
+            name=f"{self.setting['NAME']}-{index}",
+        )
+        process.start()
+        self.workers[index] = process
+        logger.info(f"worker {index} started, pid: {process.pid}")
+
+    def _check_workers(self):
+        """
+        检查子进程，异常退出的进程重启
+        """
+        for index, process in list(self.workers.items()):
+            if process.exitcode is None:
+                continue
+
+            self.workers.pop(index)
+            if process.exitcode == 0 or not self.running:
+                logger.info(f"worker {index} finished, pid: {process.pid}")
+                continue
+
+            restarts = self.restarts.get(index, 0)
+            if restarts >= self.max_restarts:
+                logger.error(f"worker {index} exit with code {process.exitcode}, too many restarts: {restarts}")
+                continue
+
+            self.restarts[index] = restarts + 1
+            logger.warning(f"worker {index} exit with code {process.exitcode}, restart {restarts + 1} times")
+            self._start_worker(index, clean=False)
+
+    async def _report(self, pool):
+        """
+        汇总各个子进程上报到redis的统计
+        """
+        client_key = f"{self.setting['NAME']}:client"
+        fields = [f"{get_mac_address()}#{process.pid}" for process in self.workers.values()]
+        if not fields:
+            return
+
+        values = await pool.hmget(client_key, fields)
+        total = {}
+        for value in values:
+            if not value:
+                continue
+            for k, v in ujson.loads(value).items():
+                if isinstance(v, (int, float)):
+                    total[k] = round(total.get(k, 0) + v, 1)
+
+        total["进程"] = len(self.workers)
+        logger.info(f"汇总统计: {ujson.dumps(total, ensure_ascii=False)}")
+
+    def stop(self, *_):
+        self.running = False
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    async def supervise(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                pass
+
+        for index in range(self.processes):
+            # 只有第一个进程按配置清空队列，其他进程等待一段时间再启动，避免清空其他进程添加的request
+            self._start_worker(index, clean=index == 0)
+            if index < self.processes - 1:
+                await asyncio.sleep(self.start_interval)
+
+        pool = None
+        if self.setting["QUEUE_CLS"] == const.RedisQueue:
+            pool = await get_aio_redis(self.setting["REDIS_SETTING"])
+
+        last_report_time = time.time()
+        try:
+            while self.workers:
+                await asyncio.sleep(1)
+                self._check_workers()
+
+                if pool and time.time() - last_report_time >= self.heart_beat_interval:
+                    last_report_time = time.time()
+                    try:
+                        await self._report(pool)
+                    except Exception as e:
+                        logger.error(f"report error: {e}")
+        finally:
+            if pool:
+                await pool.aclose()
+
+        logger.info("All workers finished!")
+
+    def run(self):
+        asyncio.run(self.supervise())
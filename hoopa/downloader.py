@@ -2,44 +2,92 @@
 """
 下载器
 """
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import aiohttp
 import httpx
 import requests
 from aiohttp import TCPConnector
+from loguru import logger
+from requests.adapters import HTTPAdapter
 
-from hoopa.request import Request
+from hoopa.request import Request, kwargs_builder
 from hoopa.response import Response
-from hoopa.utils.concurrency import run_function
+from hoopa.utils.concurrency import run_in_executor, run_in_threadpool
+from hoopa.utils.sessionpool import SessionPool, session_key
+from hoopa.utils.spool import BodySpool, check_size
 
 
 class Downloader:
     """
-    下载器基础类，子类需要实现：init, close, get_session, fetch
+    下载器基础类，子类需要实现：init, close, fetch, create_session, close_session
     同步调用：fetch
     """
     session = None
+    # 从request生成请求参数的函数，每种下载器只生成一次
+    build_kwargs = staticmethod(kwargs_builder())
 
-    def __init__(self, http_client_kwargs, engine):
+    def __init__(self, http_client_kwargs, engine, spool_size=None, spool_dir=None, max_size=0,
+                 chunk_size=64 * 1024, session_pool_size=32, session_idle_timeout=60):
         self.http_client_kwargs = http_client_kwargs
         self.engine = engine
+        # client_kwargs不为空的请求使用的session，client_kwargs相同时共用
+        self.session_pool = SessionPool(self.create_session, self.close_session, session_pool_size,
+                                        session_idle_timeout)
+        # 响应内容超过spool_size写到临时文件，超过max_size中止下载
+        self.spool_size = spool_size
+        self.spool_dir = spool_dir
+        self.max_size = max_size
+        self.chunk_size = chunk_size
 
     @classmethod
     async def create(cls, engine):
-        http_client_kwargs = engine.setting["HTTP_CLIENT_KWARGS"]
-        return cls(http_client_kwargs, engine)
+        setting = engine.setting
+        return cls(
+            setting["HTTP_CLIENT_KWARGS"],
+            engine,
+            spool_size=setting.get("DOWNLOAD_SPOOL_SIZE"),
+            spool_dir=setting.get("DOWNLOAD_SPOOL_DIR"),
+            max_size=setting.get("DOWNLOAD_MAXSIZE", 0),
+            chunk_size=setting.get("DOWNLOAD_CHUNK_SIZE", 64 * 1024),
+            session_pool_size=setting.get("SESSION_POOL_SIZE", 32),
+            session_idle_timeout=setting.get("SESSION_IDLE_TIMEOUT", 60),
+        )
 
     async def close(self):
+        await self.session_pool.close()
+
+    def create_session(self, client_kwargs):
+        """
+        用client_kwargs创建session
+        """
+        raise NotImplementedError
+
+    async def close_session(self, session):
         pass
 
     async def get_session(self, request):
         """
         1. 优先使用request参数的session
-        2. client_kwargs参数不为空，新建一个session
-        3. 全局session不为空，使用全局session
-        4. 新建一个session，提供给单次下载
+        2. client_kwargs参数不为空，使用session池里client_kwargs对应的session
+        3. 使用全局session
+        @return: session, pooled：从session池获取时pooled不为空，使用后需要调用release_session
         """
-        pass
+        if request.session:
+            return request.session, None
+        if request.client_kwargs:
+            pooled = await self.session_pool.acquire(request.client_kwargs)
+            return pooled.session, pooled
+        return self.session, None
+
+    async def release_session(self, pooled):
+        if pooled is not None:
+            await self.session_pool.release(pooled)
 
     def fetch(self, request: Request) -> Response:
         """
@@ -49,52 +97,145 @@ class Downloader:
         """
         pass
 
+    def open_body(self, request: Request, content_length=None):
+        """
+        收到响应头后调用，Content-Length超过最大字节数时直接中止下载
+        meta的stream、download_maxsize优先于配置
+        @param content_length: 响应头的Content-Length
+        @return: 需要分块读取时返回BodySpool，否则返回None，一次读取整个响应内容
+        """
+        meta = request.meta or {}
+        max_size = meta.get("download_maxsize", self.max_size)
+        spool_size = 0 if meta.get("stream") else self.spool_size
+        content_length = int(content_length) if content_length else None
+
+        if content_length is not None:
+            check_size(content_length, max_size, request.url)
+
+        # 有最大字节数时分块读取，Content-Length是压缩后的长度，不能只检查Content-Length
+        if not max_size and (spool_size is None or (content_length is not None and content_length <= spool_size)):
+            return None
+        return BodySpool(spool_size, max_size, self.spool_dir, request.url)
+
 
 class AiohttpDownloader(Downloader):
     """
     Aiohttp下载器
     """
     tc = None
+    # 连接池参数，HTTP_CLIENT_KWARGS为空时使用
+    connector_kwargs = None
+    # 连接池指标写入stats的间隔秒数，0表示不统计
+    stats_interval = 0
+    _stats_task = None
+
+    @classmethod
+    async def create(cls, engine):
+        downloader = await super().create(engine)
+        setting = engine.setting
+        connector_kwargs = {
+            "limit": setting.get("CONNECTION_LIMIT", 100),
+            "limit_per_host": setting.get("CONNECTION_LIMIT_PER_HOST", 0),
+            "ttl_dns_cache": setting.get("DNS_CACHE_TTL", 10),
+        }
+        if setting.get("CONNECTION_KEEPALIVE", True):
+            connector_kwargs["keepalive_timeout"] = setting.get("CONNECTION_KEEPALIVE_TIMEOUT", 15)
+        else:
+            connector_kwargs["force_close"] = True
+        downloader.connector_kwargs = connector_kwargs
+        downloader.stats_interval = setting.get("CONNECTION_STATS_INTERVAL", 0)
+        return downloader
 
     async def init(self):
         if self.http_client_kwargs:
             self.session = aiohttp.ClientSession(**self.http_client_kwargs)
         else:
             jar = aiohttp.DummyCookieJar()
-            self.tc = TCPConnector(limit=100, force_close=True, enable_cleanup_closed=True, verify_ssl=False)
-            self.session = aiohttp.ClientSession(connector=self.tc, cookie_jar=jar)
+            self.tc = TCPConnector(enable_cleanup_closed=True, ssl=False, **self.connector_kwargs)
+            trace_configs = [self._trace_config()] if self.stats_interval else None
+            self.session = aiohttp.ClientSession(connector=self.tc, cookie_jar=jar, trace_configs=trace_configs)
+
+        if self.stats_interval:
+            self._stats_task = asyncio.create_task(self._report_pool_stats())
 
     async def close(self):
+        if self._stats_task:
+            self._stats_task.cancel()
+        await self.session_pool.close()
         if self.tc:
             await self.tc.close()
         if self.session:
             await self.session.close()
 
-    async def get_session(self, request):
+    def create_session(self, client_kwargs):
+        return aiohttp.ClientSession(**client_kwargs)
+
+    async def close_session(self, session):
+        await session.close()
+
+    def pool_stats(self):
         """
-        1. 优先使用request参数的session
-        2. client_kwargs参数不为空，新建一个session
-        3. 使用全局session
+        连接池当前的连接数：open = acquired + idle，waiting为等待空闲连接的请求数
         """
-        is_close = False
-        if request.session:
-            session = request.session
-        elif request.client_kwargs:
-            # 单个请求创建的会话需要使用后关闭
-            is_close = True
-            session = aiohttp.ClientSession(**request.client_kwargs)
-        else:
-            session = self.session
-        return session, is_close
+        connector = self.session.connector if self.session else None
+        if connector is None:
+            return {}
+        # aiohttp没有公开连接池的状态，读取内部属性
+        acquired = len(getattr(connector, "_acquired", ()))
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        waiting = sum(len(waiters) for waiters in getattr(connector, "_waiters", {}).values())
+        return {"open": acquired + idle, "acquired": acquired, "idle": idle, "waiting": waiting}
+
+    async def _report_pool_stats(self):
+        """
+        定时把连接池的连接数和峰值写入stats
+        """
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            stats = self.engine.stats
+            for name, value in self.pool_stats().items():
+                await stats.set_value(f"downloader/connections/{name}", value)
+                await stats.max_value(f"downloader/connections/{name}_max", value)
+
+    def _trace_config(self):
+        """
+        统计新建、复用连接和等待空闲连接的次数
+        """
+        async def inc(name):
+            await self.engine.stats.inc_value(f"downloader/connections/{name}")
+
+        async def on_create(session, context, params):
+            await inc("created")
+
+        async def on_reuse(session, context, params):
+            await inc("reused")
+
+        async def on_queued(session, context, params):
+            await inc("queued")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_create)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        trace_config.on_connection_queued_start.append(on_queued)
+        return trace_config
 
     async def fetch(self, request: Request) -> Response:
-        session, is_close = await self.get_session(request)
-        _kwargs = request.replace_to_kwargs
+        session, pooled = await self.get_session(request)
+        _kwargs = self.build_kwargs(request)
         try:
             async with session.request(**_kwargs) as resp:
+                spool = self.open_body(request, resp.content_length)
+                if spool is None:
+                    body = await resp.read()
+                else:
+                    with spool:
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            spool.write(chunk)
+                        body = spool.getvalue()
+
                 response = Response(
                     url=str(resp.url),
-                    body=await resp.read(),
+                    body=body,
                     status=resp.status,
                     cookies=resp.cookies,
                     headers=resp.headers,
@@ -102,105 +243,265 @@ class AiohttpDownloader(Downloader):
                 )
                 return response
         finally:
-            if is_close:
-                await session.close()
+            await self.release_session(pooled)
+
+
+class OriginStats:
+    """
+    一个origin正在进行的请求数和用过的连接，连接关闭后自动删除
+    """
+    __slots__ = ("active", "connections")
+
+    def __init__(self):
+        self.active = 0
+        self.connections = weakref.WeakSet()
 
 
 class HttpxDownloader(Downloader):
     """
-    Httpx下载器
+    Httpx下载器，默认使用HTTP/2，同一个origin的请求在少数连接上多路复用
     """
+    build_kwargs = staticmethod(kwargs_builder({"allow_redirects": "follow_redirects"}))
+    # HTTP_CLIENT_KWARGS为空时AsyncClient的参数
+    client_kwargs = None
+    # 是否按origin统计连接复用和并发的stream数
+    origin_stats = False
+    # 单独统计的最大origin数，之后新的origin统计到downloader/origins/other
+    max_origins = 1000
+
+    @classmethod
+    async def create(cls, engine):
+        downloader = await super().create(engine)
+        setting = engine.setting
+        keepalive = setting.get("CONNECTION_KEEPALIVE", True)
+        limits = httpx.Limits(
+            max_connections=setting.get("CONNECTION_LIMIT", 100) or None,
+            max_keepalive_connections=setting.get("HTTPX_MAX_KEEPALIVE_CONNECTIONS", 20) if keepalive else 0,
+            keepalive_expiry=setting.get("CONNECTION_KEEPALIVE_TIMEOUT", 15),
+        )
+        downloader.client_kwargs = {"http2": setting.get("HTTPX_HTTP2", True), "verify": False, "limits": limits}
+        downloader.origin_stats = bool(setting.get("CONNECTION_STATS_INTERVAL"))
+        downloader.max_origins = setting.get("CONNECTION_STATS_ORIGINS", 1000)
+        return downloader
 
     async def init(self):
+        # origin -> OriginStats，只保存有进行中的请求或者连接还在的origin，按最近使用排序
+        self._origins = OrderedDict()
+        # 已经单独统计的origin
+        self._stats_origins = set()
         if self.http_client_kwargs:
             self.session = httpx.AsyncClient(**self.http_client_kwargs)
         else:
-            self.session = httpx.AsyncClient(http2=True, verify=False)
+            self.session = httpx.AsyncClient(**self.client_kwargs)
 
     async def close(self):
+        await self.session_pool.close()
         await self.session.aclose()
 
+    def create_session(self, client_kwargs):
+        return httpx.AsyncClient(**client_kwargs)
+
+    async def close_session(self, session):
+        await session.aclose()
+
     async def fetch(self, request: Request) -> Response:
-        session, is_close = await self.get_session(request)
-        _kwargs = request.replace_to_kwargs
-        _kwargs.pop('allow_redirects')
+        session, pooled = await self.get_session(request)
+        _kwargs = self.build_kwargs(request)
+        origin = self._origin(request.url) if self.origin_stats else None
+        if origin:
+            self._track_origin(origin).active += 1
         try:
-            resp = await self.session.request(**_kwargs)
-            response = Response(
-                url=str(resp.url),
-                body=resp.content,
-                status=resp.status_code,
-                cookies=resp.cookies,
-                headers=resp.headers,
-                history=resp.history,
-            )
-            return response
+            async with session.stream(**_kwargs) as resp:
+                if origin:
+                    await self._record_stream(origin, resp)
+                spool = self.open_body(request, resp.headers.get("Content-Length"))
+                if spool is None:
+                    body = await resp.aread()
+                else:
+                    with spool:
+                        async for chunk in resp.aiter_bytes(self.chunk_size):
+                            spool.write(chunk)
+                        body = spool.getvalue()
+
+                response = Response(
+                    url=str(resp.url),
+                    body=body,
+                    status=resp.status_code,
+                    cookies=resp.cookies,
+                    headers=resp.headers,
+                    history=resp.history,
+                )
+                return response
         finally:
-            if is_close:
-                await session.aclose()
+            if origin:
+                state = self._origins[origin]
+                state.active -= 1
+                if not state.active and not state.connections:
+                    self._origins.pop(origin)
+            await self.release_session(pooled)
 
-    async def get_session(self, request):
-        is_close = False
-        if request.session:
-            session = request.session
-        elif request.client_kwargs:
-            # 单个请求创建的会话需要使用后关闭
-            is_close = True
-            session = httpx.AsyncClient(**request.client_kwargs)
-        else:
-            session = self.session
+    def _track_origin(self, origin):
+        state = self._origins.get(origin)
+        if state is not None:
+            self._origins.move_to_end(origin)
+            return state
 
-        return session, is_close
+        # 超过上限时删除最久没有使用、没有进行中请求的origin，连接已经关闭的先删除
+        if len(self._origins) >= self.max_origins:
+            for key in [key for key, value in self._origins.items() if not value.active and not value.connections]:
+                self._origins.pop(key)
+            for key in [key for key, value in self._origins.items() if not value.active]:
+                if len(self._origins) < self.max_origins:
+                    break
+                self._origins.pop(key)
+
+        state = self._origins[origin] = OriginStats()
+        return state
+
+    @staticmethod
+    def _origin(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    async def _record_stream(self, origin, resp):
+        """
+        统计origin的请求数、新建连接数、复用连接的请求数和最大并发请求数，
+        HTTP/2时同一个连接上的多个请求是多路复用的stream
+        """
+        stats = self.engine.stats
+        state = self._origins[origin]
+        # 单独统计的origin数有上限，避免广度爬取时stats的key无限增长
+        if origin not in self._stats_origins and len(self._stats_origins) < self.max_origins:
+            self._stats_origins.add(origin)
+        prefix = f"downloader/origins/{origin if origin in self._stats_origins else 'other'}"
+        await stats.inc_value(f"downloader/http_version/{resp.http_version}")
+        await stats.inc_value(f"{prefix}/requests")
+        await stats.max_value(f"{prefix}/streams_max", state.active)
+
+        connection = resp.extensions.get("network_stream")
+        if connection is None:
+            return
+        if connection in state.connections:
+            await stats.inc_value(f"{prefix}/reused")
+        else:
+            state.connections.add(connection)
+            await stats.inc_value(f"{prefix}/connections")
 
 
 class RequestsDownloader(Downloader):
     """
-    Requests下载器
+    Requests下载器，在单独的线程池运行，每个线程使用自己的session
+    HTTP_CLIENT_KWARGS：session的属性（headers、proxies、verify等）和HTTPAdapter的参数（adapter_keys）
     """
+    # HTTP_CLIENT_KWARGS、client_kwargs里HTTPAdapter的参数，其他参数设置为session的属性
+    adapter_keys = ("pool_connections", "pool_maxsize", "max_retries", "pool_block")
+    # 下载线程数
+    threads = None
+    executor = None
+
+    @classmethod
+    async def create(cls, engine):
+        downloader = await super().create(engine)
+        downloader.threads = engine.setting.get("REQUESTS_THREADS") or engine.spider.worker_numbers
+        return downloader
 
     def init(self):
-        session = requests.Session()
-        if self.http_client_kwargs:
-            self.session = self.set_session(session, **self.http_client_kwargs)
-        else:
-            self.session = self.set_session(session)
+        self._local = threading.local()
+        # 所有线程创建的session，关闭时使用
+        self._sessions = []
+        self._lock = threading.Lock()
+        # 不使用默认线程池，避免和解析函数互相占用线程
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix="hoopa-requests")
+
+    async def close(self):
+        if self.executor:
+            # 取消还没开始的请求，在默认线程池等待正在下载的请求完成后再关闭session，不阻塞事件循环
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            timeout = self.engine.setting.get("SHUTDOWN_TIMEOUT")
+            try:
+                await asyncio.wait_for(run_in_threadpool(self.executor.shutdown, wait=True), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"requests downloader close: downloads still running after {timeout}s")
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+
+    def create_session(self, client_kwargs):
+        client_kwargs = dict(client_kwargs or {})
+        adapter_kwargs = {key: client_kwargs.pop(key) for key in self.adapter_keys if key in client_kwargs}
+        session = self.set_session(requests.Session(), **client_kwargs)
+        if adapter_kwargs:
+            adapter = HTTPAdapter(**adapter_kwargs)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
 
-    def close(self):
-        self.session.close()
+        with self._lock:
+            self._sessions.append(session)
+        return session
+
+    def close_session(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+        session.close()
 
     async def fetch(self, request: Request) -> Response:
-        return await run_function(self.sync_fetch, request)
+        return await run_in_executor(self.executor, self.sync_fetch, request)
 
     def sync_fetch(self, request: Request) -> Response:
-        session, is_close = self.get_session(request)
-        _kwargs = request.replace_to_kwargs
+        session = self.get_session(request)
+        _kwargs = self.build_kwargs(request)
+        # stream=True：先读取响应头，再决定一次读取还是分块读取，http_kwargs里的stream不再使用
+        _kwargs.pop("stream", None)
+        with session.request(stream=True, **_kwargs) as resp:
+            spool = self.open_body(request, resp.headers.get("Content-Length"))
+            if spool is None:
+                body = resp.content
+            else:
+                with spool:
+                    for chunk in resp.iter_content(self.chunk_size):
+                        spool.write(chunk)
+                    body = spool.getvalue()
 
-        try:
-            resp = self.session.request(**_kwargs)
             response = Response(
                 url=str(resp.url),
-                body=resp.content,
+                body=body,
                 status=resp.status_code,
                 cookies=resp.cookies,
                 headers=resp.headers,
                 history=resp.history
             )
             return response
-        finally:
-            if is_close:
-                session.close()
 
     def get_session(self, request):
-        is_close = False
+        """
+        1. 优先使用request参数的session
+        2. client_kwargs参数不为空，使用当前线程里client_kwargs对应的session
+        3. 使用当前线程的session
+        """
         if request.session:
-            session = request.session
-        elif request.client_kwargs:
-            # 单个请求创建的会话需要使用后关闭
-            session = requests.Session()
-            session = self.set_session(session, **request.client_kwargs)
+            return request.session
+
+        local = self._local
+        if not hasattr(local, "session"):
+            local.session = self.create_session(self.http_client_kwargs)
+            # client_kwargs的hash -> session，最近最少使用的先关闭
+            local.sessions = OrderedDict()
+
+        if not request.client_kwargs:
+            return local.session
+
+        key = session_key(request.client_kwargs)
+        session = local.sessions.get(key)
+        if session is None:
+            session = local.sessions[key] = self.create_session(request.client_kwargs)
+            if len(local.sessions) > self.session_pool.max_size:
+                _, oldest = local.sessions.popitem(last=False)
+                self.close_session(oldest)
         else:
-            session = requests.Session()
-        return session, is_close
+            local.sessions.move_to_end(key)
+        return session
 
     @staticmethod
     def set_session(session, **kwargs):
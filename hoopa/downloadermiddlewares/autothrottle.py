@@ -0,0 +1,123 @@
+import time
+
+from loguru import logger
+
+
+class AutoThrottleMiddleware:
+    """
+    自动限速：根据下载延迟和错误率调整域名（slot）的请求间隔和全局并发数
+    - 域名请求间隔：向 延迟/期望并发数 靠拢，出现错误时加倍，范围[DOMAIN_DELAY, AUTOTHROTTLE_MAX_DELAY]
+    - 全局并发数：延迟正常时慢慢增加，域名延迟明显高于该域名的最小延迟或者出现错误时减半，
+      范围[AUTOTHROTTLE_MIN_CONCURRENCY, WORKER_NUMBERS]
+    - 全局错误率高于AUTOTHROTTLE_ERROR_THRESHOLD时，正常的响应也不减小请求间隔、不增加并发数
+    """
+    # 判定为错误的状态码
+    error_status = {429, 503}
+
+    def __init__(self, engine, enabled=False, target_concurrency=1.0, start_delay=1, max_delay=60,
+                 min_concurrency=1, latency_factor=2, error_threshold=0.1):
+        self.engine = engine
+        self.enabled = enabled
+        self.target_concurrency = target_concurrency
+        self.start_delay = start_delay
+        self.max_delay = max_delay
+        self.latency_factor = latency_factor
+        self.error_threshold = error_threshold
+
+        self.min_delay = engine.setting["DOMAIN_DELAY"] or 0
+        self.max_concurrency = engine.spider.worker_numbers
+        self.min_concurrency = min(min_concurrency, self.max_concurrency)
+
+        # 全局错误率的指数移动平均值
+        self.error_rate = 0
+        # 连续正常的响应数，达到当前并发数时并发数加1
+        self._success_count = 0
+        self._last_decrease_time = 0
+
+    @classmethod
+    async def create(cls, engine):
+        setting = engine.setting
+        return cls(
+            engine,
+            enabled=setting.get("AUTOTHROTTLE_ENABLED", False),
+            target_concurrency=setting.get("AUTOTHROTTLE_TARGET_CONCURRENCY", 1.0),
+            start_delay=setting.get("AUTOTHROTTLE_START_DELAY", 1),
+            max_delay=setting.get("AUTOTHROTTLE_MAX_DELAY", 60),
+            min_concurrency=setting.get("AUTOTHROTTLE_MIN_CONCURRENCY", 1),
+            error_threshold=setting.get("AUTOTHROTTLE_ERROR_THRESHOLD", 0.1),
+        )
+
+    async def init(self):
+        if self.enabled:
+            # 新建的slot从初始间隔开始调整
+            slots = self.engine.scheduler.slots
+            slots.delay = max(slots.delay, self.min_delay, min(self.start_delay, self.max_delay))
+
+    async def process_response(self, request, response, spider_ins):
+        if not self.enabled:
+            return
+
+        is_error = response.status in self.error_status or response.status >= 500
+        await self._adjust(request, response.elapsed, is_error)
+
+    async def process_exception(self, request, error, spider_ins):
+        if not self.enabled:
+            return
+
+        await self._adjust(request, None, True)
+
+    async def _adjust(self, request, latency, is_error):
+        slot = await self.engine.scheduler.slots.get_slot(request)
+        old_delay = slot.delay
+
+        self.error_rate = self.error_rate * 0.8 + (0.2 if is_error else 0)
+        # 错误率还没降下来，说明服务器仍然有压力，不放松限速
+        recovering = self.error_rate > self.error_threshold
+
+        if is_error:
+            slot.delay = max(old_delay * 2, self.min_delay, 0.1)
+        elif latency is not None:
+            target_delay = latency / self.target_concurrency
+            # 请求间隔向目标值靠拢，延迟变小时只减一半，避免波动太大
+            slot.delay = max(target_delay, (old_delay + target_delay) / 2.0)
+            if recovering:
+                slot.delay = max(slot.delay, old_delay)
+        slot.delay = min(max(slot.delay, self.min_delay), self.max_delay)
+
+        congested = is_error or self._update_latency(slot, latency)
+        self._adjust_concurrency(slot, congested, recovering)
+
+        logger.debug(f"{request} autothrottle latency: {latency}, delay: {old_delay:.2f} -> {slot.delay:.2f}, "
+                     f"concurrency: {self.engine.executor.limit}, error rate: {self.error_rate:.2f}")
+
+    def _update_latency(self, slot, latency):
+        """
+        更新域名的延迟，返回延迟是否明显变大
+        """
+        if latency is None:
+            return False
+
+        slot.latency = latency if slot.latency is None else slot.latency * 0.8 + latency * 0.2
+        slot.min_latency = latency if slot.min_latency is None else min(slot.min_latency, latency)
+        return slot.latency > slot.min_latency * self.latency_factor
+
+    def _adjust_concurrency(self, slot, congested, recovering=False):
+        executor = self.engine.executor
+
+        if congested:
+            self._success_count = 0
+            # 一个延迟周期（至少1秒）内最多减一次，避免同一批请求把并发数一直减下去
+            now = time.time()
+            if now - self._last_decrease_time >= max(slot.latency or 0, 1):
+                self._last_decrease_time = now
+                executor.limit = max(self.min_concurrency, executor.limit // 2)
+            return
+
+        if recovering:
+            self._success_count = 0
+            return
+
+        self._success_count += 1
+        if self._success_count >= executor.limit:
+            self._success_count = 0
+            executor.limit = min(self.max_concurrency, executor.limit + 1)
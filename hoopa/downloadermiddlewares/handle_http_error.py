@@ -1,6 +1,7 @@
 from loguru import logger
 
 from hoopa import Response
+from hoopa.exceptions import DownloadSizeExceeded
 
 
 class HandleHttpErrorMiddleware:
@@ -12,4 +13,7 @@ class HandleHttpErrorMiddleware:
 
     async def process_exception(self, request, error, spider_ins):
         logger.error(f"{request} fetch error \n {error.stack}")
+        # 超过最大下载字节数，重试也会失败
+        if isinstance(error.exception, DownloadSizeExceeded):
+            return Response(error=error, ok=-1)
         return Response(error=error, ok=0)
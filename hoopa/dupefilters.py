@@ -7,6 +7,9 @@ from hoopa.utils.connection import get_aio_redis
 
 
 class BaseDupeFilter:
+    # 为True时使用16字节的指纹request.fp_bytes，否则使用32位16进制字符串request.fp
+    binary_fp = False
+
     async def get(self, fp):
         pass
 
@@ -24,6 +27,8 @@ class MemoryDupeFilter(BaseDupeFilter):
     """
     基于内存去重
     """
+    binary_fp = True
+
     def __init__(self, *args, **kwargs):
         self.pool = set()
 
@@ -56,18 +61,15 @@ class RedisDupeFilter(BaseDupeFilter):
         self.pool = await get_aio_redis(self.dupefilter_setting)
 
     async def get(self, fp):
-        with await self.pool as conn:
-            is_member = await conn.sismember(self.key, fp)
-            return is_member == 0
+        is_member = await self.pool.sismember(self.key, fp)
+        return not is_member
 
     async def add(self, fp):
-        with await self.pool as conn:
-            added = await conn.sadd(self.key, fp)
-            return added == 0
+        added = await self.pool.sadd(self.key, fp)
+        return added == 0
 
     async def clean_queue(self):
-        with await self.pool as conn:
-            return await conn.delete(self.key)
+        return await self.pool.delete(self.key)
 
     async def close(self):
-        self.pool.close()
+        await self.pool.aclose()
@@ -28,6 +28,11 @@ class SpiderHookError(Exception):
     pass
 
 
+class DownloadSizeExceeded(Exception):
+    """响应内容超过最大下载字节数，中止下载，不重试"""
+    pass
+
+
 class UsageError(Exception):
     """To indicate a command-line usage error"""
 
@@ -3,7 +3,11 @@
 爬虫队列
 """
 import asyncio
+import hashlib
+import heapq
 import importlib
+import itertools
+import math
 import time
 import traceback
 import typing
@@ -14,8 +18,16 @@ from loguru import logger
 
 from hoopa.request import Request
 from hoopa.response import Response
+from hoopa.utils.compression import check_method as check_compression, compress, decompress
 from hoopa.utils.connection import get_aio_redis
-from hoopa.utils.helpers import get_timestamp, get_priority_list, get_mac_pid
+from hoopa.utils.helpers import get_timestamp, get_priority_list, get_mac_pid, to_bytes
+from hoopa.utils.scripts import ScriptRegistry
+
+try:
+    import aio_pika
+    import aio_pika.pool
+except ImportError:  # pragma: no cover
+    aio_pika = None
 
 
 class BaseQueue:
@@ -26,6 +38,20 @@ class BaseQueue:
         """
         pass
 
+    async def get_many(self, count, priority):
+        """
+        从队列中获取最多count个request，队列为空时返回空列表
+        @param count: 最多获取的数量
+        @param priority: 权重，取出对应权重的request
+        """
+        requests = []
+        for _ in range(count):
+            request = await self.get(priority)
+            if request is None:
+                break
+            requests.append(request)
+        return requests
+
     async def add(self, requests: typing.Union[Request, typing.List[Request]]):
         """
         向队列添加多个request
@@ -33,12 +59,32 @@ class BaseQueue:
         """
         pass
 
-    async def set_result(self, request: Request, response: Response, task_request: Request):
+    async def set_result(self, request: Request, response: Response):
         """
         保存结果
         @param request:
         @param response:
-        @param task_request:
+        """
+        pass
+
+    async def retry(self, request: Request, delay):
+        """
+        重试：从pending删除，放进延迟队列，delay秒后回到waiting
+        @param request:
+        @param delay: 延迟秒数
+        """
+        pass
+
+    def next_retry_in(self):
+        """
+        延迟队列中最快到期的秒数，没有时返回None，用于consumer按时唤醒
+        """
+        return None
+
+    async def renew(self, requests: typing.List[Request]):
+        """
+        延长已经取出、还没有分发的request的租约，避免租约到期后被放回waiting重复抓取，没有租约的队列不需要实现
+        @param requests: 调度器暂存的request
         """
         pass
 
@@ -67,6 +113,9 @@ class MemoryQueue(BaseQueue):
         self.pending = {}
         # 失败次数记录，key为Request，value失败次数
         self.failure = {}
+        # 延迟队列，最小堆，元素为(到期时间, 序号, 优先级, 序列化的request)
+        self.delayed = []
+        self._delayed_counter = itertools.count()
         self.serialization_module = serialization_module
         self.engine = engine
 
@@ -86,6 +135,8 @@ class MemoryQueue(BaseQueue):
         """
         从队列中获取一个request
         """
+        self.promote_delayed()
+
         if not self.waiting.empty():
             result = await self.waiting.get()
             self.pending[result[1]] = get_timestamp()
@@ -101,28 +152,65 @@ class MemoryQueue(BaseQueue):
             requests = [requests]
 
         count = 0
-        # 判断是否在pending中，如果在，是否过了最大时间
         for request in requests:
             str_request = request.serialize(self.serialization_module)
-            pended_time = self.pending.get(str_request, 0)
-            if time.time() - pended_time < self.engine.setting["PENDING_THRESHOLD"]:
-                continue
-
-            count += 1
-            self.waiting.put_nowait((-request.priority, str_request))
-            if pended_time:
-                self.pending.pop(str_request)
+            count += self._put(request.priority, str_request)
         return count
 
-    async def set_result(self, request: Request, response: Response, task_request: Request):
+    def _put(self, priority, str_request):
+        """
+        放进waiting，判断是否在pending中，如果在，是否过了最大时间
+        @return: 放进waiting的个数
+        """
+        pended_time = self.pending.get(str_request, 0)
+        if time.time() - pended_time < self.engine.setting["PENDING_THRESHOLD"]:
+            return 0
+
+        self.waiting.put_nowait((-priority, str_request))
+        if pended_time:
+            self.pending.pop(str_request)
+        return 1
+
+    async def retry(self, request: Request, delay):
+        """
+        从pending删除，放进延迟队列，delay秒后回到waiting
+        @param request:
+        @param delay: 延迟秒数
+        """
+        self.pending.pop(request.snapshot(self.serialization_module), None)
+        str_request = request.serialize(self.serialization_module)
+        item = (time.time() + delay, next(self._delayed_counter), request.priority, str_request)
+        heapq.heappush(self.delayed, item)
+
+    def promote_delayed(self):
+        """
+        把延迟队列中到期的request放回waiting
+        """
+        now_time = time.time()
+        while self.delayed and self.delayed[0][0] <= now_time:
+            _, _, priority, str_request = heapq.heappop(self.delayed)
+            self.waiting.put_nowait((-priority, str_request))
+
+    def next_retry_in(self):
+        if not self.delayed:
+            return None
+        return max(self.delayed[0][0] - time.time(), 0)
+
+    async def renew(self, requests: typing.List[Request]):
+        now_time = time.time()
+        for request in requests:
+            str_request = request.snapshot(self.serialization_module)
+            if str_request in self.pending:
+                self.pending[str_request] = now_time
+
+    async def set_result(self, request: Request, response: Response):
         """
         保存结果
         @param request:
         @param response:
-        @param task_request:
         """
-        # 如果失败，且失败次数未达到，返回waiting
-        str_request = request.serialize(self.serialization_module)
+        # 取出时的序列化结果，处理过程中对request的修改不影响
+        str_request = request.snapshot(self.serialization_module)
 
         # 如果在进行队列中，删除
         if str_request in self.pending:
@@ -136,34 +224,185 @@ class MemoryQueue(BaseQueue):
             self.failure[str_request] = response.status
             return False
 
+        # 如果失败，且失败次数未达到，返回waiting
         if str_request in self.failure:
             self.failure[str_request] += 1
-            await self.add(request)
         else:
             self.failure[str_request] = 1
-            await self.add(request)
+        self._put(request.priority, str_request)
 
     async def check_status(self, spider_ins, run_forever=False):
-        if not self.pending and self.waiting.empty():
+        if not run_forever and not self.pending and self.waiting.empty() and not self.delayed:
             spider_ins.run = False
 
 
 class RedisQueue(BaseQueue):
     """
     Redis队列
+    序列化的request只在<name>:requests保存一次，key为request的id（序列化结果的hash），
+    waiting、pending、delayed、failure只保存id
+    """
+    # 存储格式的版本，旧版本的队列在启动时转换
+    LAYOUT_VERSION = 2
+    # 无法反序列化的request在失败队列中的状态
+    UNSERIALIZE_ERROR = -1
+
+    get_many_lua = """
+        redis.replicate_commands()
+        local waiting_key = KEYS[1]
+        local pending_key = KEYS[2]
+        local priority_key = KEYS[3]
+        local requests_key = KEYS[4]
+        local count = tonumber(ARGV[1])
+
+        -- pending的score为租约到期时间
+        local expire = tonumber(redis.call('TIME')[1]) + tonumber(ARGV[2])
+        local result = {}
+        -- ARGV[3]之后是成对的权重范围：min, max
+        for i = 3, table.getn(ARGV), 2 do
+            local need = count - table.getn(result) / 2
+            if need <= 0 then
+                break
+            end
+
+            local members = redis.call('zrevrangebyscore', waiting_key, ARGV[i + 1], ARGV[i], 'WITHSCORES', 'LIMIT', 0, need)
+            for j = 1, table.getn(members), 2 do
+                local id = members[j]
+                redis.call('zrem', waiting_key, id)
+                -- 没有数据的id直接丢弃
+                local data = redis.call('hget', requests_key, id)
+                if data then
+                    redis.call('zadd', pending_key, expire, id)
+                    redis.call('hset', priority_key, id, members[j + 1])
+                    table.insert(result, id)
+                    table.insert(result, data)
+                end
+            end
+        end
+        return result
     """
-    def __init__(self, spider_name, serialization_module, engine):
+
+    add_lua = """
+        redis.replicate_commands()
+        local waiting_key = KEYS[1]
+        local pending_key = KEYS[2]
+        local priority_key = KEYS[3]
+        local requests_key = KEYS[4]
+
+        local now = tonumber(redis.call('TIME')[1])
+        local add_counts = 0
+        -- ARGV为：权重, id, 数据
+        for i = 1, table.getn(ARGV), 3 do
+            local id = ARGV[i + 1]
+            -- 在pending中并且租约没有到期时不添加，租约为PENDING_THRESHOLD秒
+            local expire = redis.call('zscore', pending_key, id)
+            if (not expire) or tonumber(expire) <= now then
+                redis.call('hset', requests_key, id, ARGV[i + 2])
+                add_counts = add_counts + redis.call('zadd', waiting_key, ARGV[i], id)
+                redis.call('zrem', pending_key, id)
+                redis.call('hdel', priority_key, id)
+            end
+        end
+
+        return add_counts
+    """
+
+    promote_delayed_lua = """
+        redis.replicate_commands()
+        local delayed_key = KEYS[1]
+        local priority_key = KEYS[2]
+        local waiting_key = KEYS[3]
+        local now = ARGV[1]
+        local limit = ARGV[2]
+
+        local members = redis.call('zrangebyscore', delayed_key, '-inf', now, 'LIMIT', 0, limit)
+        for i, v in ipairs(members) do
+            local priority = redis.call('hget', priority_key, v) or 0
+            redis.call('zadd', waiting_key, priority, v)
+            redis.call('zrem', delayed_key, v)
+            redis.call('hdel', priority_key, v)
+        end
+        return table.getn(members)
+    """
+
+    reclaim_pending_lua = """
+        redis.replicate_commands()
+        local pending_key = KEYS[1]
+        local priority_key = KEYS[2]
+        local waiting_key = KEYS[3]
+        local limit = ARGV[1]
+
+        local now = redis.call('TIME')[1]
+        local members = redis.call('zrangebyscore', pending_key, '-inf', now, 'LIMIT', 0, limit)
+        for i, v in ipairs(members) do
+            local priority = redis.call('hget', priority_key, v) or 0
+            redis.call('zadd', waiting_key, priority, v)
+            redis.call('zrem', pending_key, v)
+            redis.call('hdel', priority_key, v)
+        end
+        return table.getn(members)
+    """
+
+    renew_lua = """
+        redis.replicate_commands()
+        local pending_key = KEYS[1]
+
+        local expire = tonumber(redis.call('TIME')[1]) + tonumber(ARGV[1])
+        local count = 0
+        -- ARGV[2]之后是id，只延长还在pending中的，已经被放回waiting的不再添加
+        for i = 2, table.getn(ARGV) do
+            count = count + redis.call('zadd', pending_key, 'XX', 'CH', expire, ARGV[i])
+        end
+        return count
+    """
+
+    remove_lua = """
+        redis.replicate_commands()
+        local pending_key = KEYS[1]
+        local priority_key = KEYS[2]
+        local requests_key = KEYS[3]
+        local waiting_key = KEYS[4]
+        local failure_key = KEYS[5]
+        local delayed_key = KEYS[6]
+        local id = ARGV[1]
+        local status = ARGV[2]
+
+        redis.call('zrem', pending_key, id)
+        redis.call('hdel', priority_key, id)
+        if status ~= '' then
+            redis.call('hset', failure_key, id, status)
+        elseif not redis.call('zscore', waiting_key, id) and not redis.call('zscore', delayed_key, id)
+                and redis.call('hexists', failure_key, id) == 0 then
+            -- 同一个request还在等待队列、延迟队列或者失败队列时保留数据
+            redis.call('hdel', requests_key, id)
+        end
+        return 1
+    """
+
+    def __init__(self, spider_name, serialization_module, engine, compression=None):
         self._spider_name = spider_name
         self.serialization_module = serialization_module
         self.engine = engine
+        # 压缩方式：None、zlib、zstd
+        self.compression = compression
         
         self._failure_key = f"{spider_name}:failure"
+        # pending为有序集合，score为租约到期时间，取出时的权重保存在pending:priority
         self._pending_key = f"{spider_name}:pending"
+        self._pending_priority_key = f"{spider_name}:pending:priority"
         self._waiting_key = f"{spider_name}:waiting"
         self._client_key = f"{spider_name}:client"
-        
+        # 延迟队列为有序集合，score为到期时间，权重保存在delayed:priority
+        self._delayed_key = f"{spider_name}:delayed"
+        self._delayed_priority_key = f"{spider_name}:delayed:priority"
+        # id -> 序列化的request
+        self._requests_key = f"{spider_name}:requests"
+        self._layout_key = f"{spider_name}:layout"
+
         self.pool = None
+        self.scripts = None
         self._last_check_pending_task_time = 0
+        self._last_promote_time = 0
         
         # 统计信息
         self.task_count = 0
@@ -174,13 +413,34 @@ class RedisQueue(BaseQueue):
     async def create(cls, engine):
         serialization_module = importlib.import_module(engine.setting["SERIALIZATION"])
         spider_name = engine.setting["NAME"]
-        return cls(spider_name, serialization_module, engine)
+        compression = engine.setting.get("QUEUE_COMPRESSION")
+        check_compression(compression)
+        return cls(spider_name, serialization_module, engine, compression)
 
     async def init(self):
         """
         初始化db
         """
-        self.pool = await get_aio_redis(self.engine.setting["REDIS_SETTING"])
+        # 序列化结果可能是二进制（pickle、hoopa.utils.wire），不解码返回值
+        self.pool = await get_aio_redis(self.engine.setting["REDIS_SETTING"], decode_responses=False)
+
+        # lua脚本只在启动时发送一次，之后按sha调用
+        self.scripts = ScriptRegistry(self.pool)
+        self.scripts.register("get_many", self.get_many_lua)
+        self.scripts.register("add", self.add_lua)
+        self.scripts.register("promote_delayed", self.promote_delayed_lua)
+        self.scripts.register("reclaim_pending", self.reclaim_pending_lua)
+        self.scripts.register("renew", self.renew_lua)
+        self.scripts.register("remove", self.remove_lua)
+        await self.scripts.load()
+
+        # 序列化模块需要共享数据时（hoopa.utils.wire的字典表），绑定到redis
+        bind_redis = getattr(self.serialization_module, "bind_redis", None)
+        if bind_redis:
+            self.serialization_module = bind_redis(self.pool, f"{self._spider_name}:intern")
+
+        await self._migrate_layout()
+
         loop = asyncio.get_running_loop()
         asyncio.run_coroutine_threadsafe(self.set_heart_beat(), loop=loop)
 
@@ -196,19 +456,18 @@ class RedisQueue(BaseQueue):
                 requests_per_second_all = round(requests_count / run_time, 1)
                 requests_per_second_10s = round((requests_count - last_time_requests_count) / 10, 1)
                 last_time_requests_count = requests_count
-                with await self.pool as conn:
-                    data = {
-                        "总数": self.task_count,
-                        "成功": self.task_success,
-                        "失败": self.task_failure,
-                        "请求": self.engine.requests_count,
-                        "每秒请求(全部)": requests_per_second_all,
-                        "每秒请求(10s)": requests_per_second_10s,
-                        "上报时间": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now_time)),
-                    }
-                    dumps_data = ujson.dumps(data, ensure_ascii=False)
-                    logger.info(f"统计: {dumps_data}")
-                    await conn.hset(self._client_key, get_mac_pid(), dumps_data)
+                data = {
+                    "总数": self.task_count,
+                    "成功": self.task_success,
+                    "失败": self.task_failure,
+                    "请求": self.engine.requests_count,
+                    "每秒请求(全部)": requests_per_second_all,
+                    "每秒请求(10s)": requests_per_second_10s,
+                    "上报时间": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now_time)),
+                }
+                dumps_data = ujson.dumps(data, ensure_ascii=False)
+                logger.info(f"统计: {dumps_data}")
+                await self.pool.hset(self._client_key, get_mac_pid(), dumps_data)
 
             await asyncio.sleep(10)
 
@@ -216,11 +475,14 @@ class RedisQueue(BaseQueue):
         """
         清空队列
         """
-        with await self.pool as conn:
-            # 要避免一次性删除过大的key，导致redis阻塞
-            await conn.delete(self._failure_key)
-            await conn.delete(self._pending_key)
-            await conn.delete(self._waiting_key)
+        # 要避免一次性删除过大的key，导致redis阻塞
+        await self.pool.delete(self._failure_key)
+        await self.pool.delete(self._pending_key)
+        await self.pool.delete(self._pending_priority_key)
+        await self.pool.delete(self._waiting_key)
+        await self.pool.delete(self._delayed_key)
+        await self.pool.delete(self._delayed_priority_key)
+        await self.pool.delete(self._requests_key)
 
     async def get(self, priority: typing.Union[int, list]):
         """
@@ -228,6 +490,16 @@ class RedisQueue(BaseQueue):
         @param priority: 为None的时候，获取所有权重，否则获取指定的权重，可以是int，也可以是int列表
         @return: request
         """
+        requests = await self.get_many(1, priority)
+        return requests[0] if requests else None
+
+    async def get_many(self, count, priority: typing.Union[int, list]):
+        """
+        调用一次lua脚本从redis中获取最多count个request，按权重范围的顺序取，每个范围内权重高的先取
+        @param count: 最多获取的数量
+        @param priority: 为None的时候，获取所有权重，否则获取指定的权重，可以是int，也可以是int列表
+        @return: request列表
+        """
         priority_list = []
         if priority is None:
             priority_list.append(("-inf", "+inf"))
@@ -237,34 +509,26 @@ class RedisQueue(BaseQueue):
             priority_list = get_priority_list(priority)
 
         try:
-            lua = """
-                redis.replicate_commands()
-                local waiting_key = KEYS[1]
-                local pending_key = KEYS[2]
-                local min = KEYS[3]
-                local max = KEYS[4]
-
-                -- 取值
-                local result = redis.call('zrevrangebyscore', waiting_key, max, min, 'LIMIT', 0, 1)
-
-                if result and table.getn(result) > 0 then
-                    redis.call('zrem', waiting_key, result[1])
-                    redis.call('hset', pending_key, result[1], redis.call('TIME')[1])
-                    return result[1]
-                end
-                return nil
-            """
-            with await self.pool as conn:
-                for p_item in priority_list:
-                    _min, _max  = p_item
-                    eval_result = await conn.eval(lua, keys=[self._waiting_key, self._pending_key, _min, _max], args=[])
-                    if eval_result:
-                        self.task_count += 1
-                        return Request.unserialize(eval_result, self.serialization_module)
+            await self.promote_delayed()
+
+            args = [item for p_item in priority_list for item in p_item]
+            keys = (self._waiting_key, self._pending_key, self._pending_priority_key, self._requests_key)
+            eval_result = await self.scripts.call("get_many", keys, (count, self.engine.setting["PENDING_THRESHOLD"], *args))
         except Exception as e:
             logger.error(f"get request error \n{traceback.format_exc()}")
-
-        return None
+            return []
+
+        requests = []
+        for request_id, data in zip(eval_result[::2], eval_result[1::2]):
+            try:
+                requests.append(await self._unserialize(decompress(data)))
+            except Exception:
+                # 无法反序列化的request放到失败队列，不影响同一批的其他request
+                logger.error(f"unserialize request error \n{traceback.format_exc()}")
+                await self._remove_id(request_id, self.UNSERIALIZE_ERROR)
+                self.task_failure += 1
+        self.task_count += len(requests)
+        return requests
 
     async def add(self, requests):
         """
@@ -275,119 +539,450 @@ class RedisQueue(BaseQueue):
         if not isinstance(requests, list):
             requests = [requests]
 
-        str_requests = [_.serialize(self.serialization_module) for _ in requests]
-        priority_list = [_.priority for _ in requests]
-        lua = """
-            redis.replicate_commands()
-            local priority_list = KEYS
-            local requests = ARGV
-
-            local spider = table.remove(priority_list, 1)
-
-            local now = redis.call('TIME')[1]
-            local waiting_key = spider..':waiting'
-            local pending_key = spider..':pending'
-
-            local add_counts = 0
-            for i, v in ipairs(requests) do
-                -- 判断在pending中的时间
-                local score = redis.call('hget', pending_key, v)
-                if (score and tonumber(now) - tonumber(score) >= 30) or (not score) then
-                    local result = redis.call('zadd', waiting_key, priority_list[i], v)
-                    add_counts = add_counts + result
-                    redis.call('hdel', pending_key, v)
-                end
-            end
+        # 序列化之前给重复出现的值分配字典表编号
+        if hasattr(self.serialization_module, "prepare"):
+            await self.serialization_module.prepare(requests)
 
-            return add_counts
-        """
-        with await self.pool as conn:
-            add_counts = await conn.eval(lua, keys=[self._spider_name] + priority_list, args=str_requests)
+        args = []
+        for request in requests:
+            args.extend((request.priority, *self._pack(request.serialize(self.serialization_module))))
+        keys = (self._waiting_key, self._pending_key, self._pending_priority_key, self._requests_key)
+        add_counts = await self.scripts.call("add", keys, args)
         return add_counts
 
-    async def set_result(self, request: Request, response: Response, task_request: Request):
+    def _pack(self, request_ser):
+        """
+        返回request的id和压缩后的数据，id为序列化结果的hash，相同的request得到相同的id
+        """
+        request_ser = to_bytes(request_ser)
+        return self._request_id(request_ser), compress(request_ser, self.compression)
+
+    @staticmethod
+    def _request_id(request_ser):
+        return hashlib.blake2b(to_bytes(request_ser), digest_size=12).digest()
+
+    async def retry(self, request: Request, delay):
+        """
+        从pending删除，放进延迟队列，delay秒后回到waiting。
+        延迟队列为有序集合，score为到期时间，member为id，权重保存在delayed:priority
+        @param request:
+        @param delay: 延迟秒数
+        """
+        await self._remove(request)
+        request_id, data = self._pack(request.serialize(self.serialization_module))
+        pipe = self.pool.pipeline()
+        pipe.hset(self._requests_key, request_id, data)
+        pipe.zadd(self._delayed_key, {request_id: time.time() + delay})
+        pipe.hset(self._delayed_priority_key, request_id, request.priority)
+        await pipe.execute()
+
+    async def promote_delayed(self, limit=100):
+        """
+        把延迟队列中到期的request放回waiting，每秒最多执行一次
+        """
+        now_time = time.time()
+        if now_time - self._last_promote_time < 1:
+            return
+        self._last_promote_time = now_time
+
+        keys = (self._delayed_key, self._delayed_priority_key, self._waiting_key)
+        count = await self.scripts.call("promote_delayed", keys, (now_time, limit))
+        if count:
+            logger.debug(f"delayed to waiting: {count}")
+
+    async def renew(self, requests: typing.List[Request]):
+        """
+        把暂存的request的租约延长到 当前时间 + PENDING_THRESHOLD
+        """
+        if not requests:
+            return
+        ids = [self._request_id(request.snapshot(self.serialization_module)) for request in requests]
+        await self.scripts.call("renew", (self._pending_key,), (self.engine.setting["PENDING_THRESHOLD"], *ids))
+
+    async def set_result(self, request: Request, response: Response):
         """
         保存结果，设置状态（成功或失败）
         @param request:
         @param response:
-        @param task_request:
         @return:
         """
+        if response.ok == 1:
+            # 成功，从pending删除，同时删除数据
+            await self._remove(request)
+            self.task_success += 1
+        else:
+            # 失败，从pending删除，放到失败队列
+            await self._remove(request, response.status)
+            self.task_failure += 1
 
-        request_ser = request.serialize(self.serialization_module)
-        with await self.pool as conn:
-            if response.ok == 1:
-                # 成功，删除pending队列
-                await conn.hdel(self._pending_key, request_ser)
-                self.task_success += 1
-            else:
-                # 失败, 从等待队列中删除，并放到失败队列
-                pipe = conn.pipeline()
-                pipe.hdel(self._pending_key, request_ser)
-                pipe.hset(self._failure_key, request_ser, response.status)
-                await pipe.execute()
-                self.task_failure += 1
+    async def _remove(self, request: Request, status=None):
+        """
+        从pending删除，status不为None时放到失败队列
+        """
+        await self._remove_id(self._request_id(request.snapshot(self.serialization_module)), status)
+
+    async def _remove_id(self, request_id, status=None):
+        keys = (self._pending_key, self._pending_priority_key, self._requests_key, self._waiting_key,
+                self._failure_key, self._delayed_key)
+        await self.scripts.call("remove", keys, (request_id, "" if status is None else status))
 
     async def check_status(self, spider_ins, run_forever=False):
-        with await self.pool as conn:
-            pending_len = await conn.hlen(self._pending_key)
-            waiting_len = await conn.zcard(self._waiting_key)
-            if not pending_len and not waiting_len:
-                spider_ins.run = False
+        pipe = self.pool.pipeline()
+        pipe.zcard(self._pending_key)
+        pipe.zcard(self._waiting_key)
+        pipe.zcard(self._delayed_key)
+        pending_len, waiting_len, delayed_len = await pipe.execute()
+        if not run_forever and not pending_len and not waiting_len and not delayed_len:
+            spider_ins.run = False
 
         await self.check_pending_task()
 
-    async def check_pending_task(self):
-        # 判断是否有超时的链接
+    async def check_pending_task(self, limit=1000):
+        """
+        把租约到期的request放回waiting，每10秒执行一次，每次lua脚本最多处理limit个，避免redis阻塞
+        """
         now_time = time.time()
         if now_time - self._last_check_pending_task_time > 10:
             self._last_check_pending_task_time = now_time
-            now_time = time.time()
-
-            with await self.pool as conn:
-                pending_list = await conn.hgetall(self._pending_key)
 
-                to_waiting_list = []
-                del_pending_list = []
-                for k, v in pending_list.items():
-                    if now_time - int(v) > self.engine.setting["PENDING_THRESHOLD"]:
-                        request = Request.unserialize(k, self.serialization_module)
-                        to_waiting_list.extend([request.priority, k])
-                        del_pending_list.append(k)
+            keys = (self._pending_key, self._pending_priority_key, self._waiting_key)
+            total = 0
+            while True:
+                count = await self.scripts.call("reclaim_pending", keys, (limit,))
+                total += count
+                if count < limit:
+                    break
 
-                if to_waiting_list:
-                    pipe = conn.pipeline()
-                    pipe.zadd(self._waiting_key, *to_waiting_list)
-                    pipe.hdel(self._pending_key, *del_pending_list)
-                    result = await pipe.execute()
+            if total:
+                logger.info(f"pending timeout to waiting: {total}")
 
-                    logger.info(f"pendings: {len(pending_list)}, del_pending: {result[1]}, add_waitings: {result[0]}")
+    async def _migrate_layout(self, batch=1000):
+        """
+        旧版本的waiting、pending、delayed、failure直接保存序列化的request，启动时转换成只保存id，
+        pending中的request放回waiting。升级时需要先停止所有进程
+        """
+        if await self.pool.get(self._layout_key):
+            return
+
+        keys = (self._waiting_key, self._pending_key, self._delayed_key, self._failure_key)
+        if await self.pool.exists(*keys) and not await self.pool.exists(self._requests_key):
+            waiting = {}
+            async for member, score in self.pool.zscan_iter(self._waiting_key, count=batch):
+                waiting[member] = score
+            if await self.pool.type(self._pending_key) == b"hash":
+                pending_list = await self.pool.hkeys(self._pending_key)
+            else:
+                pending_list = await self.pool.zrange(self._pending_key, 0, -1)
+            for member in pending_list:
+                request = await self._unserialize(member)
+                waiting[member] = request.priority
+
+            # (序列化的request, key, score, 延迟队列的权重)
+            entries = [(member, self._waiting_key, score, None) for member, score in waiting.items()]
+            async for member, score in self.pool.zscan_iter(self._delayed_key, count=batch):
+                priority, _, request_ser = member.partition(b":")
+                entries.append((request_ser, self._delayed_key, score, priority))
+            failure = await self.pool.hgetall(self._failure_key)
+            entries.extend((member, self._failure_key, status, None) for member, status in failure.items())
+
+            await self.pool.delete(*keys, self._pending_priority_key)
+            pipe = self.pool.pipeline()
+            for index, (request_ser, key, score, priority) in enumerate(entries, 1):
+                request_id, data = self._pack(request_ser)
+                pipe.hset(self._requests_key, request_id, data)
+                if key == self._failure_key:
+                    pipe.hset(key, request_id, score)
+                else:
+                    pipe.zadd(key, {request_id: score})
+                if priority is not None:
+                    pipe.hset(self._delayed_priority_key, request_id, priority)
+                if index % batch == 0:
+                    await pipe.execute()
+            await pipe.execute()
+            logger.info(f"migrate redis queue to layout {self.LAYOUT_VERSION}: {len(entries)}")
+
+        await self.pool.set(self._layout_key, self.LAYOUT_VERSION)
 
     async def failure_to_waiting(self, spider_ins):
-
-        with await self.pool as conn:
-            failure_list: dict = await conn.hgetall(self._failure_key)
+        failure_list = await self.pool.hkeys(self._failure_key)
 
         if failure_list:
-            zadd_list = []
+            zadd_dict = {}
             hdel_list = []
-            for key, value in failure_list.items():
-                request = Request.unserialize(key)
-                zadd_list.extend([request.priority, key])
+            data_list = await self.pool.hmget(self._requests_key, failure_list)
+            for key, data in zip(failure_list, data_list):
+                # 没有数据的id直接删除
+                if data is not None:
+                    try:
+                        request = await self._unserialize(decompress(data))
+                    except Exception:
+                        # 无法反序列化的request留在失败队列
+                        logger.error(f"unserialize request error \n{traceback.format_exc()}")
+                        continue
+                    zadd_dict[key] = request.priority
                 hdel_list.append(key)
 
-            if zadd_list:
-                with await self.pool as conn:
-                    try:
-                        pipe = conn.pipeline()
-                        pipe.zadd(self._waiting_key, *zadd_list)
-                        pipe.hdel(self._failure_key, *hdel_list)
-                        await pipe.execute()
-                    except:
-                        logger.debug(traceback.format_exc())
-                        logger.error("failure_to_waiting error")
+            if hdel_list:
+                try:
+                    pipe = self.pool.pipeline()
+                    if zadd_dict:
+                        pipe.zadd(self._waiting_key, zadd_dict)
+                    pipe.hdel(self._failure_key, *hdel_list)
+                    await pipe.execute()
+                except:
+                    logger.debug(traceback.format_exc())
+                    logger.error("failure_to_waiting error")
+
+                logger.info(f"failure_to_waiting, result: {len(hdel_list)}")
+
+    async def _unserialize(self, data):
+        """
+        反序列化，遇到其他进程新加的字典表编号时从redis加载字典表后重试
+        """
+        try:
+            return Request.unserialize(data, self.serialization_module)
+        except LookupError:
+            if not hasattr(self.serialization_module, "sync"):
+                raise
+            await self.serialization_module.sync()
+            return Request.unserialize(data, self.serialization_module)
+
+    async def close(self):
+        await self.pool.aclose()
+
+
+class RabbitMQQueue(BaseQueue):
+    """
+    RabbitMQ队列，需要安装aio-pika：pip install hoopa[mq]
+    - <name>：等待队列，优先级队列（x-max-priority为MQ_MAX_PRIORITY），消费者最多预取MQ_PREFETCH个未确认的消息
+    - 取出的消息保存在request.message，成功后ack，失败后reject，由死信转到<name>:failure，代替redis的pending
+    - <name>:delayed:<秒数>：重试的延迟队列，没有消费者，消息过期后由死信转回<name>，空闲时自动删除
+    - 在slot中暂存的request还没有确认，同样占用预取额度
+    """
+
+    def __init__(self, spider_name, serialization_module, engine, uri, pool_size=10, max_priority=10, prefetch=1):
+        self._spider_name = spider_name
+        self.serialization_module = serialization_module
+        self.engine = engine
+        self.uri = uri
+        self.pool_size = pool_size
+        self.max_priority = max_priority
+        self.prefetch = prefetch
+
+        self._waiting_name = spider_name
+        self._failure_name = f"{spider_name}:failure"
+
+        self.connection = None
+        # 消费者使用的channel
+        self.channel = None
+        # 发布消息使用的channel池
+        self.channel_pool = None
+        self.waiting_queue = None
+        self.failure_queue = None
+        # 消费者收到、还没取出的消息
+        self._buffer = asyncio.Queue()
+        self._consumer_tag = None
+        # 收到、还没确认的消息数，包括_buffer里的消息
+        self._unacked = 0
+        # 本进程放进延迟队列的消息的到期时间，最小堆
+        self._delayed = []
+        # 连续检查到队列为空的次数
+        self._empty_checks = 0
+
+        # 统计信息
+        self.task_count = 0
+        self.task_success = 0
+        self.task_failure = 0
+
+    @classmethod
+    async def create(cls, engine):
+        if aio_pika is None:
+            raise ImportError("QUEUE_CLS = RabbitMQQueue requires aio-pika, run: pip install hoopa[mq]")
+
+        setting = engine.setting
+        serialization_module = importlib.import_module(setting["SERIALIZATION"])
+        return cls(
+            setting["NAME"],
+            serialization_module,
+            engine,
+            setting["MQ_URI"],
+            pool_size=setting.get("MQ_MAXSIZE", 10),
+            max_priority=setting.get("MQ_MAX_PRIORITY", 10),
+            prefetch=setting.get("MQ_PREFETCH") or engine.spider.worker_numbers,
+        )
+
+    async def init(self):
+        self.connection = await aio_pika.connect_robust(self.uri)
+        self.channel = await self.connection.channel()
+        # 未确认的消息数达到prefetch后，broker暂停推送
+        await self.channel.set_qos(prefetch_count=self.prefetch)
+        self.channel_pool = aio_pika.pool.Pool(self.connection.channel, max_size=self.pool_size)
+
+        self.failure_queue = await self.channel.declare_queue(self._failure_name, durable=True)
+        self.waiting_queue = await self.channel.declare_queue(self._waiting_name, durable=True, arguments={
+            "x-max-priority": self.max_priority,
+            # reject(requeue=False)的消息转到失败队列
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": self._failure_name,
+        })
+
+    async def _consume(self):
+        """
+        第一次取request时开始消费，避免clean_queue之前预取消息
+        """
+        if self._consumer_tag is None:
+            self._consumer_tag = await self.waiting_queue.consume(self._on_message)
+
+    async def _on_message(self, message):
+        self._unacked += 1
+        self._buffer.put_nowait(message)
+        # 唤醒等待中的consumer
+        scheduler = getattr(self.engine, "scheduler", None)
+        if scheduler:
+            scheduler.notify()
+
+    async def _settle(self, message, action, **kwargs):
+        """
+        确认消息，连接重建后旧消息的确认会失败，broker会重新投递这些消息
+        @param action: ack, nack, reject
+        """
+        self._unacked -= 1
+        try:
+            await getattr(message, action)(**kwargs)
+        except Exception:
+            logger.error(f"rabbitmq {action} error \n{traceback.format_exc()}")
+
+    async def _publish(self, routing_key, body, priority=0, **kwargs):
+        message = aio_pika.Message(
+            to_bytes(body),
+            priority=max(0, min(priority, self.max_priority)),
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            **kwargs
+        )
+        async with self.channel_pool.acquire() as channel:
+            await channel.default_exchange.publish(message, routing_key=routing_key)
+
+    async def clean_queue(self):
+        """
+        清空队列
+        """
+        await self.waiting_queue.purge()
+        await self.failure_queue.purge()
+
+    async def get(self, priority):
+        """
+        从消费者收到的消息中取一个request，优先级由broker处理，不支持指定优先级
+        """
+        await self._consume()
+
+        try:
+            message = self._buffer.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+        try:
+            request = Request.unserialize(message.body, self.serialization_module)
+        except Exception:
+            logger.error(f"unserialize request error \n{traceback.format_exc()}")
+            await self._settle(message, "reject", requeue=False)
+            return None
+
+        request.message = message
+        self.task_count += 1
+        return request
+
+    async def add(self, requests):
+        """
+        向队列添加request
+        @param requests: request列表
+        @return: 添加的个数
+        """
+        if not isinstance(requests, list):
+            requests = [requests]
+
+        for request in requests:
+            await self._publish(self._waiting_name, request.serialize(self.serialization_module), request.priority)
+        return len(requests)
+
+    async def retry(self, request: Request, delay):
+        """
+        放进<name>:delayed:<秒数>，过期后由死信转回等待队列，再确认原来的消息
+        @param request:
+        @param delay: 延迟秒数，向上取整
+        """
+        seconds = max(int(math.ceil(delay)), 1)
+        ttl = seconds * 1000
+        name = f"{self._spider_name}:delayed:{seconds}"
+        async with self.channel_pool.acquire() as channel:
+            await channel.declare_queue(name, durable=True, arguments={
+                "x-message-ttl": ttl,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self._waiting_name,
+                # 一分钟没有使用时删除
+                "x-expires": ttl + 60000,
+            })
+        await self._publish(name, request.serialize(self.serialization_module), request.priority)
+        heapq.heappush(self._delayed, time.time() + seconds)
+
+        if request.message is not None:
+            await self._settle(request.message, "ack")
+            request.message = None
+
+    async def set_result(self, request: Request, response: Response):
+        """
+        成功ack，失败reject转到失败队列，ok为0时放回等待队列
+        @param request:
+        @param response:
+        """
+        message = request.message
+        if message is None:
+            return
+        request.message = None
+
+        if response.ok == 1:
+            await self._settle(message, "ack")
+            self.task_success += 1
+        elif response.ok == -1:
+            await self._settle(message, "reject", requeue=False)
+            self.task_failure += 1
+        else:
+            await self._settle(message, "nack", requeue=True)
+
+    async def check_status(self, spider_ins, run_forever=False):
+        if run_forever or self._unacked:
+            self._empty_checks = 0
+            return
+
+        # 延迟队列的消息到期后才会回到等待队列，多等1秒
+        now_time = time.time()
+        while self._delayed and self._delayed[0] + 1 < now_time:
+            heapq.heappop(self._delayed)
+        if self._delayed:
+            return
+
+        # message_count不包括已经推送给消费者、还没收到的消息，连续两次检查都为空才结束
+        queue = await self.channel.declare_queue(self._waiting_name, passive=True)
+        if queue.declaration_result.message_count or self._unacked:
+            self._empty_checks = 0
+            return
+        self._empty_checks += 1
+        if self._empty_checks >= 2:
+            spider_ins.run = False
+
+    async def failure_to_waiting(self, spider_ins):
+        count = 0
+        while True:
+            message = await self.failure_queue.get(no_ack=False, fail=False)
+            if message is None:
+                break
+            await self._publish(self._waiting_name, message.body, message.priority or 0)
+            await message.ack()
+            count += 1
 
-                    logger.info(f"failure_to_waiting, result: {len(hdel_list)}")
+        logger.info(f"failure_to_waiting, result: {count}")
 
     async def close(self):
-        self.pool.close()
+        if self.channel_pool:
+            await self.channel_pool.close()
+        if self.connection:
+            await self.connection.close()
@@ -3,6 +3,7 @@
 request对象
 """
 
+import operator
 from types import SimpleNamespace
 from typing import (Any, Iterable, Mapping, Optional, Union, Callable)
 
@@ -27,13 +28,13 @@ from hoopa.utils import helpers
 from hoopa.utils.serialization import loads, dumps
 
 
-not_serialize_params = ["session", "message", 'http_kwargs', "retries"]
+not_serialize_params = ["session", "message", 'http_kwargs', "origin"]
 
 serialize_params = ['url', 'headers', 'method', 'params', 'data', 'json', 'meta', 'dont_filter', 'priority',
-                    'callback', 'client_kwargs', 'http_kwargs']
+                    'callback', 'client_kwargs', 'http_kwargs', 'retries']
 
 not_kwargs_list = ["session", "message", "callback", "dont_filter", "meta", "priority",
-                   "client_kwargs", "http_kwargs", "retries", "retry_times", "retry_delay"]
+                   "client_kwargs", "http_kwargs", "retries", "retry_times", "retry_delay", "origin"]
 
 
 class AiohttpParams:
@@ -109,10 +110,78 @@ class OtherParams:
     # 重试时的间隔
     retry_delay = 0
 
-    http_kwargs = None
+    # 从队列取出时的序列化结果，作为request在队列中的稳定标识
+    origin = None
 
 
-class Request(AiohttpParams, HttpxParams, RequestParams, OtherParams):
+# 固定字段，保存在__slots__里，其他请求参数保存在_extra字典
+request_fields = ('url', 'method', 'headers', 'params', 'data', 'json', 'cookies', 'timeout', 'allow_redirects',
+                  'callback', 'meta', 'dont_filter', 'priority', 'retry_times', 'retry_delay', 'client_kwargs',
+                  'retries', 'session', 'message', 'origin')
+
+# 修改后需要重新计算指纹的字段，保存在下划线开头的slot
+fingerprint_fields = ('url', 'method', 'params', 'data', 'json')
+
+# 序列化时放在顶层的字段，其他字段和_extra放在http_kwargs
+_serialize_fields = tuple(name for name in serialize_params if name in request_fields)
+_http_kwargs_fields = tuple(name for name in request_fields
+                            if name not in serialize_params and name not in not_serialize_params)
+# 请求参数的固定字段
+_kwargs_fields = tuple(name for name in request_fields if name not in not_kwargs_list)
+
+_get_serialize_fields = operator.attrgetter(*_serialize_fields)
+_get_http_kwargs_fields = operator.attrgetter(*_http_kwargs_fields)
+
+
+def _get_param_defaults():
+    """
+    各个下载器参数的默认值，同名参数按AiohttpParams、HttpxParams、RequestParams、OtherParams的顺序取
+    """
+    defaults = {}
+    for params_cls in (OtherParams, RequestParams, HttpxParams, AiohttpParams):
+        for name, value in vars(params_cls).items():
+            if not name.startswith("_"):
+                defaults[name] = value
+    return defaults
+
+
+param_defaults = _get_param_defaults()
+
+
+def kwargs_builder(rename=None):
+    """
+    生成从request取请求参数的函数，每种下载器只生成一次
+    @param rename: 参数改名，例如httpx的allow_redirects改为follow_redirects
+    """
+    rename = rename or {}
+    names = tuple(rename.get(name, name) for name in _kwargs_fields)
+    getter = operator.attrgetter(*_kwargs_fields)
+
+    def build(request):
+        _kwargs = {name: value for name, value in zip(names, getter(request)) if value is not None}
+        # 不在固定字段里面的参数都设置到请求参数
+        if request._extra:
+            for name, value in request._extra.items():
+                if value is not None:
+                    _kwargs.setdefault(rename.get(name, name), value)
+
+        # 把params字典的值统一转为str类型
+        _params = _kwargs.get("params", None)
+        if _params:
+            _kwargs["params"] = {k: str(v) for k, v in _params.items()}
+        return _kwargs
+
+    return build
+
+
+class Request:
+    """
+    request的固定字段保存在__slots__，其他请求参数（proxy、verify等）保存在_extra，
+    request.proxy = xxx 和 request.set("proxy", xxx) 都可以，没有设置的参数返回下载器参数的默认值
+    """
+    __slots__ = tuple(f"_{name}" if name in fingerprint_fields else name for name in request_fields) + \
+        ('_extra', '_fp')
+
     def __init__(
             self,
             url,
@@ -131,8 +200,12 @@ class Request(AiohttpParams, HttpxParams, RequestParams, OtherParams):
             retry_times=3,
             retry_delay=1,
             client_kwargs=None,
+            retries=0,
             **_http_kwargs
     ):
+        # 指纹缓存，修改url、method、params、data、json或者读取字典、列表类型的params、data、json时清空
+        self._fp = None
+
         self.url = url
         self.headers = headers
         self.method = method
@@ -143,6 +216,11 @@ class Request(AiohttpParams, HttpxParams, RequestParams, OtherParams):
         self.cookies = cookies
         self.timeout = timeout
 
+        self.session = None
+        self.message = None
+        self.origin = None
+        self._extra = None
+
         # 其他参数
         for key, value in _http_kwargs.items():
             self.set(key, value)
@@ -162,13 +240,43 @@ class Request(AiohttpParams, HttpxParams, RequestParams, OtherParams):
 
         self.retry_times = retry_times
         self.retry_delay = retry_delay
-        self.retries = 0
+        # 已重试次数，重试时放进延迟队列，需要序列化
+        self.retries = retries
 
     def __getitem__(self, item):
         return getattr(self, item)
 
+    def __getattr__(self, name):
+        # 属性内部抛出AttributeError时也会到这里，重新调用属性，抛出原来的异常
+        if hasattr(type(self), name):
+            return object.__getattribute__(self, name)
+        # 只有__slots__和参数属性之外的名字才会到这里，从_extra获取
+        if not name.startswith("_"):
+            extra = object.__getattribute__(self, "_extra")
+            if extra and name in extra:
+                return extra[name]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
     def set(self, name, value):
-        setattr(self, name, value)
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            self._set_extra(name, value)
+
+    def _set_extra(self, name, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[name] = value
+
+    @property
+    def http_kwargs(self):
+        """
+        固定字段之外的请求参数
+        """
+        _http_kwargs = dict(zip(_http_kwargs_fields, _get_http_kwargs_fields(self)))
+        if self._extra:
+            _http_kwargs.update(self._extra)
+        return _http_kwargs
 
     @staticmethod
     def unserialize(data_str, module=None):
@@ -177,25 +285,40 @@ class Request(AiohttpParams, HttpxParams, RequestParams, OtherParams):
         _request = Request(**data)
         for k, v in http_kwargs.items():
             _request.set(k, v)
+        _request.origin = data_str
         return _request
 
+    def to_dict(self):
+        request_dict = dict(zip(_serialize_fields, _get_serialize_fields(self)))
+        request_dict["http_kwargs"] = self.http_kwargs
+        return request_dict
+
     def serialize(self, module=None):
-        request_dict = {}
-        _http_kwargs = {}
-        for name, value in vars(self).items():
-            if name not in not_serialize_params:
-                # 不在request参数里面的参数都设置到http_kwargs
-                if name in serialize_params:
-                    request_dict.setdefault(name, value)
-                else:
-                    _http_kwargs[name] = value
-        request_dict["http_kwargs"] = _http_kwargs
-        return dumps(request_dict, module)
+        return dumps(self.to_dict(), module)
+
+    def snapshot(self, module=None):
+        """
+        request在队列中的标识：从队列取出时的序列化结果，新建的request直接序列化
+        @param module: 序列化模块
+        """
+        if self.origin is not None:
+            return self.origin
+        return self.serialize(module)
 
     def copy(self):
-        kwargs = vars(self)
-        cls = kwargs.pop('cls', self.__class__)
-        return cls(**kwargs)
+        kwargs = self.to_dict()
+        kwargs.update(kwargs.pop("http_kwargs"))
+        _request = self.__class__(**kwargs)
+        _request.session = self.session
+        _request.message = self.message
+        return _request
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
 
     @property
     def replace_to_kwargs(self):
@@ -203,32 +326,73 @@ class Request(AiohttpParams, HttpxParams, RequestParams, OtherParams):
         生成请求参数
         @return:
         """
-        _kwargs = {}
-        for name, value in vars(self).items():
-            if value is not None and name not in not_kwargs_list:
-                # 不在not_kwargs_list里面的参数都设置到http_kwargs
-                _kwargs.setdefault(name, value)
+        return _build_kwargs(self)
 
-        # 把params字典的值统一转为str类型
-        _params = _kwargs.get("params", None)
-        if _params:
-            _new_params = {}
-            for k, v in _params.items():
-                _new_params[k] = str(v)
-            _kwargs["params"] = _new_params
-        return _kwargs
+    @property
+    def fp_bytes(self):
+        """
+        16字节的指纹，第一次访问时计算并缓存，直到url、method、params、data、json被重新赋值或者读取了可变的值
+        """
+        if self._fp is None:
+            self._fp = helpers.request_fingerprint(self)
+        return self._fp
 
     @property
     def fp(self):
-        return helpers.request_fingerprint(self)
+        return self.fp_bytes.hex()
 
     @property
     def request_url(self):
         _url = self.url
         if self.params:
-            _url = add_or_replace_parameters(self.url, self.params)
+            _url = add_or_replace_parameters(self.url, {k: str(v) for k, v in self.params.items()})
 
         return canonicalize_url(_url)
 
     def __repr__(self):
         return f"<Request p{self.priority} {self.method} {self.request_url}>"
+
+
+def _extra_property(name, default):
+    def fget(self):
+        extra = self._extra
+        if extra and name in extra:
+            return extra[name]
+        return default
+
+    def fset(self, value):
+        self._set_extra(name, value)
+
+    def fdel(self):
+        if self._extra:
+            self._extra.pop(name, None)
+
+    return property(fget, fset, fdel)
+
+
+def _fingerprint_property(name):
+    attr = f"_{name}"
+
+    def fget(self):
+        value = getattr(self, attr)
+        # 字典、列表取出后可能被原地修改（request.params["page"] = 2），指纹缓存不再可靠
+        if isinstance(value, (dict, list)):
+            self._fp = None
+        return value
+
+    def fset(self, value):
+        setattr(self, attr, value)
+        self._fp = None
+
+    return property(fget, fset)
+
+
+for _name in fingerprint_fields:
+    setattr(Request, _name, _fingerprint_property(_name))
+
+# 下载器的其他参数生成属性，保存在_extra
+for _name, _default in param_defaults.items():
+    if _name not in request_fields and not hasattr(Request, _name):
+        setattr(Request, _name, _extra_property(_name, _default))
+
+_build_kwargs = kwargs_builder()
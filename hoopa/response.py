@@ -5,12 +5,12 @@ response对象
 import codecs
 from dataclasses import dataclass
 
-import charset_normalizer
 import ujson
 from aiohttp import helpers
 from parsel import Selector
 
 from hoopa.exceptions import Error
+from hoopa.utils.encoding import detect_encoding
 from hoopa.utils.url import get_location_from_history
 
 
@@ -28,7 +28,8 @@ class Response:
         body: bytes = b'',
         text: str = "",
         error: Error = None,
-        ok: int = 1
+        ok: int = 1,
+        elapsed: float = 0
     ):
         self._url = url
         self._encoding = encoding
@@ -39,11 +40,18 @@ class Response:
 
         self._body = body
         self._text = text
+        # text从body解码时为True，release时可以删除
+        self._text_decoded = False
+        # 缓存的解析结果
+        self._selector = None
+        self._json = None
 
         self._error: Error = error  # 错误
 
         self._ok: int = ok  # 请求状态： 1成功；0失败，会进行重试；-1失败，不进行失败，直接进入失败队列
 
+        self._elapsed: float = elapsed  # 下载耗时，单位秒
+
     @property
     def url(self):
         return self._url
@@ -67,14 +75,27 @@ class Response:
         if not self._encoding:
             self._encoding = self.get_encoding()
 
-        return self._body.decode(self._encoding, errors=errors)
+        # 只解码一次
+        # body可能是写到临时文件的mmap
+        self._text = str(self._body, self._encoding, errors)
+        self._text_decoded = True
+        return self._text
 
     @text.setter
     def text(self, value: str):
         self._text = value
+        self._text_decoded = False
+        self._selector = None
+        self._json = None
 
     def json(self, *args, **kwargs):
-        return ujson.loads(self.text, *args, **kwargs)
+        # 有参数时不缓存
+        if args or kwargs:
+            return ujson.loads(self.text, *args, **kwargs)
+
+        if self._json is None:
+            self._json = ujson.loads(self.text)
+        return self._json
 
     @property
     def ok(self):
@@ -92,6 +113,14 @@ class Response:
     def error(self, value: str):
         self._error = value
 
+    @property
+    def elapsed(self):
+        return self._elapsed
+
+    @elapsed.setter
+    def elapsed(self, value: float):
+        self._elapsed = value
+
     @property
     def headers(self):
         return self._headers
@@ -114,7 +143,10 @@ class Response:
 
     @property
     def selector(self):
-        return Selector(self.text)
+        # 只解析一次，多次调用xpath、css使用同一个解析树
+        if self._selector is None:
+            self._selector = Selector(self.text)
+        return self._selector
 
     def xpath(self, xpath_str):
         return self.selector.xpath(xpath_str)
@@ -125,6 +157,16 @@ class Response:
     def css(self, re_str):
         return self.selector.css(re_str)
 
+    def release(self):
+        """
+        删除缓存的text、解析树和json，释放内存，之后再访问会重新解码和解析
+        """
+        if self._text_decoded:
+            self._text = ""
+            self._text_decoded = False
+        self._selector = None
+        self._json = None
+
     def serialize(self):
         request_dict = {}
         for item in ["url", "status", "body", 'text', 'encoding', "ok"]:
@@ -147,7 +189,8 @@ class Response:
             elif self._body is None:
                 raise RuntimeError("Cannot guess the encoding of " "a not yet read body")
             else:
-                encoding = charset_normalizer.detect(self._body)["encoding"]
+                # 先看BOM和<meta charset>，再检测body的前缀，同一个网站的检测结果会缓存
+                encoding = detect_encoding(self._body, self._url, c_type)
         if not encoding:
             encoding = "utf-8"
 
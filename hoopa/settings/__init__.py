@@ -16,11 +16,19 @@ spider_attr_list = [
     'name',
     'worker_numbers',
     'download_delay',
+    'domain_concurrency',
+    'domain_delay',
+    'rate_limit',
+    'domain_rate_limit',
     'pending_threshold',
     'run_forever',
     'queue_cls',
     'clean_queue',
     'priority',
+    'mq_uri',
+    'mq_maxsize',
+    'mq_max_priority',
+    'mq_prefetch',
     'downloader_cls',
     'http_client_kwargs',
     'dupefilter_cls',
@@ -35,9 +43,11 @@ spider_attr_list = [
     'log_level',
     'log_write_file',
     'serialization',
+    'queue_compression',
     'interrupt_with_error',
     'push_number',
-    'failure_to_waiting'
+    'failure_to_waiting',
+    'process_pool',
 ]
 
 
@@ -143,6 +153,7 @@ class Setting:
         if queue_cls == const.RedisQueue:
             body += f"\n{blank}{'clean_queue':28s}: {self.get('CLEAN_QUEUE')}"
             body += f"\n{blank}{'priority':28s}: {self.get('PRIORITY')}"
+            body += f"\n{blank}{'queue_compression':28s}: {self.get('QUEUE_COMPRESSION')}"
         elif queue_cls == const.RabbitMQQueue:
             body += f"\n{blank}{'clean_queue':28s}: {self.get('CLEAN_QUEUE')}"
 
@@ -89,33 +89,28 @@ class RedisStatsCollector(StatsCollector):
 
     async def get_value(self, key, default=None, spider=None):
         """Return the value of hash stats"""
-        with await self.pool as conn:
-            if await conn.hexists(self.stats_key, key):
-                return int(await conn.hget(self.stats_key, key))
-            else:
-                return default
+        value = await self.pool.hget(self.stats_key, key)
+        if value is None:
+            return default
+        return int(value)
 
     async def get_stats(self, spider=None):
         """Return the all of the values of hash stats"""
-        with await self.pool as conn:
-            return await conn.hgetall(self.stats_key)
+        return await self.pool.hgetall(self.stats_key)
 
     async def set_value(self, key, value, spider=None):
         """Set the value according to hash key of stats"""
-        with await self.pool as conn:
-            return await conn.hset(self.stats_key, key, value)
+        return await self.pool.hset(self.stats_key, key, value)
 
     async def set_stats(self, stats, spider=None):
         """Set all the hash stats"""
-        with await self.pool as conn:
-            await conn.hmset(self.stats_key, stats)
+        await self.pool.hset(self.stats_key, mapping=stats)
 
     async def inc_value(self, key, count=1, start=0, spider=None):
         """Set increment of value according to key"""
-        with await self.pool as conn:
-            if not await conn.hexists(self.stats_key, key):
-                await self.set_value(key, start)
-            await conn.hincrby(self.stats_key, key, count)
+        if start:
+            await self.pool.hsetnx(self.stats_key, key, start)
+        await self.pool.hincrby(self.stats_key, key, count)
 
     async def max_value(self, key, value, spider=None):
         """Set max value between current and new value"""
@@ -126,4 +121,4 @@ class RedisStatsCollector(StatsCollector):
         await self.set_value(key, min(await self.get_value(key, value), value))
 
     async def close(self):
-        self.pool.close()
+        await self.pool.aclose()
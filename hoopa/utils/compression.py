@@ -0,0 +1,72 @@
+# encoding: utf-8
+"""
+队列中request的压缩：第一个字节标记压缩方式，压缩后没有变小时保存原始数据，读取时按标记解压，
+修改压缩方式后之前保存的数据依然可以读取
+
+zstd需要安装zstandard：pip install hoopa[zstd]
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# 压缩方式的标记
+RAW = b"\x00"
+ZLIB = b"\x01"
+ZSTD = b"\x02"
+
+METHODS = (None, "zlib", "zstd")
+
+_zstd_compressor = None
+_zstd_decompressor = None
+
+
+def _zstd():
+    global _zstd_compressor, _zstd_decompressor
+    if zstandard is None:
+        raise ImportError("queue compression 'zstd' requires zstandard, run: pip install hoopa[zstd]")
+    if _zstd_compressor is None:
+        _zstd_compressor = zstandard.ZstdCompressor()
+        _zstd_decompressor = zstandard.ZstdDecompressor()
+    return _zstd_compressor, _zstd_decompressor
+
+
+def check_method(method):
+    """
+    检查压缩方式，zstd没有安装时抛出ImportError
+    @param method: None、zlib、zstd
+    """
+    if method not in METHODS:
+        raise ValueError(f"unsupported compression: {method}, choose from {METHODS}")
+    if method == "zstd":
+        _zstd()
+
+
+def compress(data: bytes, method=None):
+    """
+    @param data: 序列化后的request
+    @param method: None、zlib、zstd
+    @return: 带标记的数据
+    """
+    if method == "zlib":
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return ZLIB + compressed
+    elif method == "zstd":
+        compressed = _zstd()[0].compress(data)
+        if len(compressed) < len(data):
+            return ZSTD + compressed
+    return RAW + data
+
+
+def decompress(data: bytes):
+    tag, body = data[:1], data[1:]
+    if tag == RAW:
+        return body
+    if tag == ZLIB:
+        return zlib.decompress(body)
+    if tag == ZSTD:
+        return _zstd()[1].decompress(body)
+    raise ValueError(f"unknown compression tag: {tag!r}")
@@ -12,9 +12,12 @@ except ImportError:  # pragma: no cover
 T = typing.TypeVar("T")
 
 
-async def run_in_threadpool(
-    func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any
+async def run_in_executor(
+    executor, func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any
 ) -> T:
+    """
+    在指定的线程池运行，executor为None时使用默认线程池
+    """
     loop = asyncio.get_event_loop()
     if contextvars is not None:  # pragma: no cover
         # Ensure we run in the same context
@@ -25,7 +28,13 @@ async def run_in_threadpool(
     elif kwargs:  # pragma: no cover
         # loop.run_in_executor doesn't accept 'kwargs', so bind them in here
         func = functools.partial(func, **kwargs)
-    return await loop.run_in_executor(None, func, *args)
+    return await loop.run_in_executor(executor, func, *args)
+
+
+async def run_in_threadpool(
+    func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any
+) -> T:
+    return await run_in_executor(None, func, *args, **kwargs)
 
 
 async def run_function(callable_fun,  *args, **kwargs) -> Any:
@@ -56,7 +65,37 @@ def _next(iterator: Iterator) -> Any:
         raise _StopIteration
 
 
-async def iterate_in_threadpool(iterator: Iterator) -> AsyncGenerator:
+async def iterate_async(iterable) -> AsyncGenerator:
+    for item in iterable:
+        yield item
+
+
+def _next_chunk(iterator: Iterator, chunk_size: int) -> tuple:
+    # 一次在线程池取多个元素，减少线程切换的开销，出错时先返回已经取出的元素
+    chunk = []
+    try:
+        for item in iterator:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                break
+    except Exception as e:
+        return chunk, e
+    return chunk, None
+
+
+async def iterate_in_threadpool(iterator: Iterator, chunk_size: int = 1) -> AsyncGenerator:
+    if chunk_size > 1:
+        iterator = iter(iterator)
+        while True:
+            chunk, error = await run_in_threadpool(_next_chunk, iterator, chunk_size)
+            for item in chunk:
+                yield item
+            if error is not None:
+                raise error
+            if len(chunk) < chunk_size:
+                break
+        return
+
     while True:
         try:
             yield await run_in_threadpool(_next, iterator)
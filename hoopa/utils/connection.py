@@ -24,10 +24,11 @@ def get_redis_uri_from_dict(**kwargs):
     return uri
 
 
-async def get_aio_redis(redis_setting):
+async def get_aio_redis(redis_setting, decode_responses=True):
     """
     创建aioredis连接池
     @param redis_setting: redis配置dict或者uri
+    @param decode_responses: 是否把返回值解码为str，保存二进制数据时为False
     @return:
     """
     if isinstance(redis_setting, dict):
@@ -38,11 +39,11 @@ async def get_aio_redis(redis_setting):
             db=redis_setting.get("db", 0),
             password=redis_setting.get("password"),
             encoding=redis_setting.get("encoding", "utf-8"),
-            decode_responses=True
+            decode_responses=decode_responses
         )
     else:
         # 使用 URI 创建连接
-        return aioredis.from_url(redis_setting, decode_responses=True)
+        return aioredis.from_url(redis_setting, decode_responses=decode_responses)
 
 
 @asynccontextmanager
@@ -0,0 +1,164 @@
+# encoding: utf-8
+"""
+响应编码检测：按 BOM、<meta charset>、检测body前缀的顺序确定编码，检测结果按 host + content-type 缓存
+"""
+import codecs
+import re
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import charset_normalizer
+
+# 检测编码时最多使用body的前多少字节
+SAMPLE_SIZE = 64 * 1024
+# 查找<meta charset>的范围
+META_SCAN_SIZE = 4096
+# 缓存的 host + content-type 数量
+CACHE_SIZE = 1024
+
+# 长的BOM放在前面，utf-32-le的BOM以utf-16-le的BOM开头
+BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# <meta charset="gbk"> 或 <meta http-equiv="Content-Type" content="text/html; charset=gbk">
+# xml声明：<?xml version="1.0" encoding="gbk"?>
+META_CHARSET_RE = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?\s*([a-zA-Z0-9_:.\-]+)|<\?xml[^>]+encoding\s*=\s*["']([a-zA-Z0-9_:.\-]+)""",
+    re.IGNORECASE
+)
+
+
+def normalize_encoding(encoding):
+    """
+    返回python的编码名称，不支持的编码返回None
+    """
+    if not encoding:
+        return None
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return None
+
+
+def bom_encoding(body: bytes):
+    # body可能是mmap，没有startswith
+    head = body[:4]
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    return None
+
+
+def meta_encoding(body: bytes):
+    match = META_CHARSET_RE.search(body, 0, META_SCAN_SIZE)
+    if not match:
+        return None
+    encoding = normalize_encoding((match.group(1) or match.group(2)).decode("ascii"))
+    # 页面是utf-16时不会出现ascii的meta，声明utf-16是错误的
+    if encoding and encoding.startswith("utf-16"):
+        return "utf-8"
+    return encoding
+
+
+def _sample(body: bytes, size):
+    if len(body) <= size:
+        # body可能是mmap，charset_normalizer只接受bytes
+        return bytes(body)
+    sample = body[:size]
+    # 在换行处截断，避免把多字节字符截断一半
+    index = sample.rfind(b"\n")
+    if index > size // 2:
+        sample = sample[:index + 1]
+    return sample
+
+
+def _can_decode(sample: bytes, encoding):
+    try:
+        # final=False：末尾不完整的多字节字符不算解码失败
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+
+class EncodingCache:
+    """
+    host + content-type -> 检测出的编码，最近最少使用的先删除
+    @param max_size: 缓存数量
+    """
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+
+    def get(self, key):
+        encoding = self._cache.get(key)
+        if encoding is not None:
+            self._cache.move_to_end(key)
+        return encoding
+
+    def set(self, key, encoding):
+        self._cache[key] = encoding
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def pop(self, key):
+        self._cache.pop(key, None)
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+default_cache = EncodingCache()
+
+
+def cache_key(url, content_type):
+    """
+    缓存的key：host + 不带参数的content-type
+    """
+    host = urlsplit(url).netloc if url else ""
+    return host, content_type.split(";", 1)[0].strip()
+
+
+def detect_encoding(body: bytes, url="", content_type="", cache: EncodingCache = default_cache,
+                    sample_size=SAMPLE_SIZE):
+    """
+    header里没有charset时检测body的编码
+    @param body: 响应内容
+    @param url: 响应的url，用于按host缓存检测结果
+    @param content_type: 响应头的Content-Type
+    @param cache: 检测结果的缓存，为None时不缓存
+    @param sample_size: 最多检测body的前多少字节
+    @return: 编码，检测不出来时返回None
+    """
+    if not body:
+        return None
+
+    encoding = bom_encoding(body) or meta_encoding(body)
+    if encoding:
+        return encoding
+
+    sample = _sample(body, sample_size)
+    key = cache_key(url, content_type) if cache is not None else None
+    if key is not None:
+        encoding = cache.get(key)
+        # 同一个网站的页面一般是同一个编码，能解码就直接使用
+        if encoding and _can_decode(sample, encoding):
+            return encoding
+
+    encoding = normalize_encoding(charset_normalizer.detect(sample)["encoding"])
+    # 前缀只有ascii时，后面的内容可能有其他字符，使用兼容ascii的utf-8
+    if encoding == "ascii":
+        encoding = "utf-8"
+    if encoding and key is not None:
+        cache.set(key, encoding)
+    return encoding
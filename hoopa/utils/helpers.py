@@ -5,9 +5,11 @@ import os
 import random
 import uuid
 from asyncio import iscoroutinefunction
+from email.utils import parsedate_to_datetime
 from importlib import import_module
 
 import arrow
+import ujson
 
 from hoopa.utils.concurrency import run_function_no_concurrency
 
@@ -64,14 +66,36 @@ async def create_instance_and_init(objcls, engine, *args, **kwargs):
     return instance
 
 
+def canonical_body(body):
+    """
+    请求体的规范形式，字典、列表转成按key排序的json，避免key顺序不同导致指纹不同
+    """
+    if body is None:
+        return b''
+    if isinstance(body, bytes):
+        return body
+    if isinstance(body, (dict, list, tuple)):
+        try:
+            return to_bytes(ujson.dumps(body, sort_keys=True, ensure_ascii=False))
+        except (TypeError, OverflowError):
+            pass
+    return to_bytes(str(body))
+
+
 def request_fingerprint(request):
-    fp = hashlib.md5()
-    fp.update(to_bytes(request.method))
+    """
+    请求指纹：方法 + url(包含query string) + 请求体data + 请求体json，16字节blake2b
+    """
+    fp = hashlib.blake2b(digest_size=16)
+    fp.update(to_bytes(request.method.upper()))
+    fp.update(b'\n')
     fp.update(to_bytes(request.request_url))
-    fp.update(to_bytes(str(request.data)) or b'')
-    fp.update(to_bytes(str(request.json)) or b'')
+    fp.update(b'\n')
+    fp.update(canonical_body(request.data))
+    fp.update(b'\n')
+    fp.update(canonical_body(request.json))
 
-    return fp.hexdigest()
+    return fp.digest()
 
 
 async def spider_sleep(download_delay):
@@ -88,6 +112,48 @@ async def spider_sleep(download_delay):
     await asyncio.sleep(max(download_delay, 0.01))
 
 
+def get_retry_delay(retries, retry_delay, backoff=2, max_delay=60, jitter=0.5, retry_after=None):
+    """
+    计算重试间隔：指数退避加随机抖动，服务器返回了Retry-After时不小于Retry-After
+    @param retries: 第几次重试，从1开始
+    @param retry_delay: 第一次重试的间隔
+    @param backoff: 退避倍数，第n次重试间隔为 retry_delay * backoff ** (n - 1)
+    @param max_delay: 最大间隔
+    @param jitter: 随机抖动比例，间隔在 [delay * (1 - jitter), delay] 之间
+    @param retry_after: Retry-After秒数
+    """
+    delay = min(retry_delay * backoff ** max(retries - 1, 0), max_delay)
+    if jitter:
+        delay = random.uniform(delay * (1 - jitter), delay)
+    if retry_after:
+        delay = max(delay, retry_after)
+    return min(delay, max_delay)
+
+
+def get_retry_after(headers):
+    """
+    解析Retry-After响应头，可以是秒数，也可以是http日期
+    @return: 秒数，没有或者无法解析时返回None
+    """
+    if not headers:
+        return None
+
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_time.timestamp() - arrow.now().float_timestamp, 0)
+
+
 def to_str(bytes_or_str, encoding="utf-8", errors='strict'):
     if isinstance(bytes_or_str, bytes):
         value = bytes_or_str.decode(encoding, errors)
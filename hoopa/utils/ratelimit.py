@@ -0,0 +1,144 @@
+# encoding: utf-8
+"""
+令牌桶限速：每秒产生rate个令牌，桶里最多存burst个令牌，每个请求消耗一个令牌
+"""
+import asyncio
+import time
+
+from hoopa.utils.scripts import ScriptRegistry
+
+
+class TokenBucket:
+    """
+    本地令牌桶
+    """
+
+    def __init__(self, rate, burst=1):
+        # 每秒产生的令牌数
+        self.rate = rate
+        # 桶的容量，即允许的突发请求数
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def wait_time(self, n=1):
+        """
+        距离有n个令牌的秒数，不消耗令牌
+        """
+        self._refill()
+        if self.tokens >= n:
+            return 0
+        return (n - self.tokens) / self.rate
+
+    async def consume(self, n=1):
+        """
+        尝试消耗n个令牌
+        @return: 0表示消耗成功，否则为需要等待的秒数，令牌不足时不消耗
+        """
+        wait = await self.wait_time(n)
+        if not wait:
+            self.tokens -= n
+        return wait
+
+    async def refund(self, n=1):
+        """
+        放回n个令牌，不超过桶的容量
+        """
+        self._refill()
+        self.tokens = min(self.burst, self.tokens + n)
+
+    async def acquire(self, n=1):
+        """
+        等待直到消耗n个令牌
+        """
+        while True:
+            wait = await self.consume(n)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} rate={self.rate} burst={self.burst}>"
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    保存在redis的令牌桶，多个进程、多台机器共享同一个速率，使用redis服务器的时间计算令牌数
+    """
+    lua = """
+        redis.replicate_commands()
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local n = tonumber(ARGV[3])
+        local consume = tonumber(ARGV[4])
+
+        local redis_time = redis.call('TIME')
+        local now = tonumber(redis_time[1]) + tonumber(redis_time[2]) / 1000000
+
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+
+        local wait = 0
+        if tokens >= n then
+            if consume == 1 then
+                tokens = tokens - n
+            end
+        else
+            wait = (n - tokens) / rate
+        end
+
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        -- 令牌桶装满后就和不存在一样，过期删除
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+        return tostring(wait)
+    """
+
+    def __init__(self, pool, key, rate, burst=1, scripts: ScriptRegistry = None):
+        """
+        @param scripts: 多个令牌桶共用的脚本注册表，为None时单独创建
+        """
+        super().__init__(rate, burst)
+        self.pool = pool
+        self.key = key
+        if scripts is None:
+            scripts = ScriptRegistry(pool)
+        if "token_bucket" not in scripts.scripts:
+            scripts.register("token_bucket", self.lua)
+        self.scripts = scripts
+
+    async def _eval(self, n, consume):
+        wait = await self.scripts.call("token_bucket", (self.key,), (self.rate, self.burst, n, int(consume)))
+        return float(wait)
+
+    async def wait_time(self, n=1):
+        return await self._eval(n, False)
+
+    async def consume(self, n=1):
+        return await self._eval(n, True)
+
+    async def refund(self, n=1):
+        # 消耗负数个令牌，超过容量的部分在下次计算时截断
+        await self._eval(-n, True)
+
+
+def bucket_factory(pool=None, prefix=""):
+    """
+    返回创建令牌桶的函数
+    @param pool: redis连接，不为空时令牌桶保存在redis
+    @param prefix: redis key的前缀
+    """
+    scripts = ScriptRegistry(pool) if pool is not None else None
+
+    def create(key, rate, burst=1):
+        if pool is None:
+            return TokenBucket(rate, burst)
+        return RedisTokenBucket(pool, f"{prefix}:{key}", rate, burst, scripts)
+
+    return create
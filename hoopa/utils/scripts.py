@@ -0,0 +1,64 @@
+# encoding: utf-8
+"""
+redis的lua脚本注册表：每个脚本只用SCRIPT LOAD发送一次，之后用EVALSHA按sha调用，
+redis重启、SCRIPT FLUSH或者切换到从库后收到NOSCRIPT时自动重新加载
+"""
+from redis.exceptions import NoScriptError
+
+
+class RedisScript:
+    """
+    @param source: lua脚本
+    """
+    __slots__ = ("source", "sha")
+
+    def __init__(self, source):
+        self.source = source
+        # SCRIPT LOAD返回的sha，没有加载时为None
+        self.sha = None
+
+
+class ScriptRegistry:
+    """
+    @param pool: redis连接
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.scripts = {}
+
+    def register(self, name, source):
+        """
+        注册脚本，相同的名称重复注册时覆盖
+        @param name: 脚本名称，调用时使用
+        @param source: lua脚本
+        """
+        self.scripts[name] = RedisScript(source)
+
+    async def load(self, name=None):
+        """
+        用SCRIPT LOAD加载脚本，name为None时加载全部脚本
+        """
+        names = list(self.scripts) if name is None else [name]
+        for _name in names:
+            script = self.scripts[_name]
+            sha = await self.pool.script_load(script.source)
+            script.sha = sha.decode() if isinstance(sha, bytes) else sha
+
+    async def call(self, name, keys=(), args=()):
+        """
+        用EVALSHA调用脚本
+        @param name: 脚本名称
+        @param keys: 脚本的KEYS
+        @param args: 脚本的ARGV
+        @return: 脚本的返回值
+        """
+        script = self.scripts[name]
+        if script.sha is None:
+            await self.load(name)
+
+        try:
+            return await self.pool.evalsha(script.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            await self.load(name)
+            return await self.pool.evalsha(script.sha, len(keys), *keys, *args)
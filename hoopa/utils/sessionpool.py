@@ -0,0 +1,111 @@
+# encoding: utf-8
+"""
+按client_kwargs缓存的session池：client_kwargs相同的请求共用一个session，复用连接
+"""
+import hashlib
+import time
+from collections import OrderedDict
+
+
+def _freeze(value):
+    """
+    转成稳定的可比较结构，字典按key排序
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(repr(_freeze(v)) for v in value))
+    return value
+
+
+def session_key(client_kwargs):
+    """
+    client_kwargs的hash，字典顺序不影响结果；
+    没有稳定repr的对象（例如connector）按对象区分，同一个对象得到同一个key
+    """
+    return hashlib.blake2b(repr(_freeze(client_kwargs)).encode(), digest_size=16).hexdigest()
+
+
+class PooledSession:
+    __slots__ = ("key", "session", "refs", "last_used", "evicted")
+
+    def __init__(self, key, session):
+        self.key = key
+        self.session = session
+        # 正在使用的请求数，为0时才能关闭
+        self.refs = 0
+        self.last_used = time.monotonic()
+        # 已经从池中删除，最后一个请求完成后关闭
+        self.evicted = False
+
+
+class SessionPool:
+    """
+    session池，超过max_size时关闭最近最少使用的session，空闲超过idle_timeout秒的session也会关闭
+    @param factory: 用client_kwargs创建session的函数
+    @param closer: 关闭session的协程函数
+    @param max_size: 最多缓存的session数
+    @param idle_timeout: 空闲多少秒后关闭，0或None表示不关闭
+    """
+
+    def __init__(self, factory, closer, max_size=32, idle_timeout=60):
+        self.factory = factory
+        self.closer = closer
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()
+
+    async def acquire(self, client_kwargs) -> PooledSession:
+        """
+        获取client_kwargs对应的session，使用完需要调用release
+        """
+        key = session_key(client_kwargs)
+        pooled = self._sessions.get(key)
+        if pooled is None:
+            pooled = self._sessions[key] = PooledSession(key, self.factory(client_kwargs))
+        else:
+            self._sessions.move_to_end(key)
+        pooled.refs += 1
+        pooled.last_used = time.monotonic()
+
+        await self._evict()
+        return pooled
+
+    async def release(self, pooled: PooledSession):
+        pooled.refs -= 1
+        pooled.last_used = time.monotonic()
+        if pooled.evicted and pooled.refs <= 0:
+            await self.closer(pooled.session)
+
+    async def _evict(self):
+        """
+        删除空闲超时和超过数量的session，正在使用的session在release时关闭
+        """
+        evicted = []
+        if self.idle_timeout:
+            deadline = time.monotonic() - self.idle_timeout
+            evicted.extend(pooled for pooled in self._sessions.values()
+                           if pooled.refs <= 0 and pooled.last_used < deadline)
+            for pooled in evicted:
+                del self._sessions[pooled.key]
+
+        while len(self._sessions) > self.max_size:
+            _, pooled = self._sessions.popitem(last=False)
+            evicted.append(pooled)
+
+        for pooled in evicted:
+            pooled.evicted = True
+            if pooled.refs <= 0:
+                await self.closer(pooled.session)
+
+    async def close(self):
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for pooled in sessions:
+            pooled.evicted = True
+            await self.closer(pooled.session)
+
+    def __len__(self):
+        return len(self._sessions)
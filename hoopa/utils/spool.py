@@ -0,0 +1,88 @@
+# encoding: utf-8
+"""
+分块保存响应内容：小的响应保存在内存，超过spool_size后写到临时文件，读取时使用只读的mmap，
+下载大文件时内存占用不会随文件大小增长
+"""
+import mmap
+import tempfile
+
+from hoopa.exceptions import DownloadSizeExceeded
+
+
+def check_size(size, max_size, url=""):
+    """
+    超过最大字节数时抛出DownloadSizeExceeded
+    @param size: 已下载或者Content-Length的字节数
+    @param max_size: 最大字节数，0或None表示不限制
+    """
+    if max_size and size > max_size:
+        raise DownloadSizeExceeded(f"<{url}> response size {size} exceeds download maxsize {max_size}")
+
+
+class BodySpool:
+    """
+    @param spool_size: 超过多少字节写到临时文件，0表示总是写到临时文件，None表示不写临时文件
+    @param max_size: 最大字节数，超过时抛出DownloadSizeExceeded，0或None表示不限制
+    @param spool_dir: 临时文件目录，None使用系统临时目录
+    @param url: 请求的url，用于异常信息
+    """
+
+    def __init__(self, spool_size=None, max_size=0, spool_dir=None, url=""):
+        self.spool_size = spool_size
+        self.max_size = max_size
+        self.spool_dir = spool_dir
+        self.url = url
+        # 已写入的字节数
+        self.size = 0
+        self._chunks = []
+        self._file = None
+
+    @property
+    def spooled(self):
+        return self._file is not None
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        check_size(self.size, self.max_size, self.url)
+
+        if self._file is not None:
+            self._file.write(chunk)
+            return
+
+        self._chunks.append(chunk)
+        if self.spool_size is not None and self.size > self.spool_size:
+            # 临时文件创建后立即删除目录项，关闭后磁盘空间自动回收
+            self._file = tempfile.TemporaryFile(dir=self.spool_dir)
+            self._file.writelines(self._chunks)
+            self._chunks = []
+
+    def getvalue(self):
+        """
+        返回响应内容：保存在内存时为bytes，写到临时文件时为只读的mmap，
+        mmap支持切片、find、len、正则匹配和buffer协议，需要bytes时使用bytes(body)
+        """
+        if self._file is None:
+            body = b"".join(self._chunks)
+            self._chunks = []
+            return body
+
+        try:
+            if not self.size:
+                return b""
+            self._file.flush()
+            # mmap持有自己的文件描述符，关闭文件后依然可以读取，mmap被回收时释放临时文件
+            return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            self.close()
+
+    def close(self):
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
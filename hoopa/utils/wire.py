@@ -0,0 +1,319 @@
+# encoding: utf-8
+"""
+request的二进制序列化格式：msgpack编码，字段按固定位置存放并省略默认值，
+回调函数名、请求头、url的 scheme://host 通过字典表替换为编号
+
+使用：SERIALIZATION = "hoopa.utils.wire"，需要安装msgpack：pip install hoopa[msgpack]
+RedisQueue会把字典表保存在redis，多个进程共享同一个字典表；其他队列不使用字典表
+"""
+import itertools
+
+from hoopa.utils.scripts import ScriptRegistry
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    raise ImportError("SERIALIZATION = 'hoopa.utils.wire' requires msgpack, run: pip install hoopa[msgpack]")
+
+# 格式版本，放在第一个位置
+VERSION = 1
+
+# 字典表编号的msgpack扩展类型
+EXT_REF = 1
+
+# 按位置存放的字段和默认值，url固定放在第二个位置，其他字段是默认值时省略，用位掩码标记存在的字段
+FIELDS = ('headers', 'method', 'params', 'data', 'json', 'meta', 'dont_filter', 'priority', 'callback',
+          'client_kwargs', 'retries', 'cookies', 'timeout', 'allow_redirects', 'retry_times', 'retry_delay')
+DEFAULTS = {
+    'headers': None,
+    'method': 'get',
+    'params': None,
+    'data': None,
+    'json': None,
+    'meta': None,
+    'dont_filter': False,
+    'priority': 0,
+    'callback': None,
+    'client_kwargs': {},
+    'retries': 0,
+    'cookies': None,
+    'timeout': 10,
+    'allow_redirects': True,
+    'retry_times': 3,
+    'retry_delay': 1,
+}
+# 放在http_kwargs里的字段
+HTTP_KWARGS_FIELDS = ('cookies', 'timeout', 'allow_redirects', 'retry_times', 'retry_delay')
+TOP_DEFAULTS = {name: value for name, value in DEFAULTS.items() if name not in HTTP_KWARGS_FIELDS}
+HTTP_KWARGS_DEFAULTS = {name: value for name, value in DEFAULTS.items() if name in HTTP_KWARGS_FIELDS}
+# 其他http_kwargs的位置
+EXTRA_BIT = len(FIELDS)
+# 放进字典表的字段
+INTERN_FIELDS = ('headers', 'callback')
+
+
+class UnknownInternId(KeyError):
+    pass
+
+
+def split_origin(url):
+    """
+    把url拆成 scheme://host 和剩余部分
+    """
+    index = url.find("://")
+    if index < 0:
+        return None, url
+    index = url.find("/", index + 3)
+    if index < 0:
+        return url, ""
+    return url[:index], url[index:]
+
+
+class InternTable:
+    """
+    字典表：值和编号的对应关系，同一个值出现threshold次以上才放进字典表，最多max_size个
+    @param auto: 序列化时是否自动分配编号，保存在redis时由RedisInternTable.prepare批量分配。
+                 自动分配的编号只在当前进程有效，其他进程无法反序列化，而且同一个request放进字典表前后的序列化结果不同
+    @param threshold: 出现多少次才放进字典表
+    """
+
+    def __init__(self, max_size=10000, auto=True, threshold=2):
+        self.max_size = max_size
+        self.auto = auto
+        self.threshold = threshold
+        # 规范化的值 -> 编号
+        self.ids = {}
+        # 编号 -> 值
+        self.values = {}
+        # 还没放进字典表的值出现的次数
+        self._seen = {}
+        self._counter = itertools.count(1)
+
+    @staticmethod
+    def key(value):
+        if isinstance(value, str):
+            return b"s" + value.encode()
+        return b"d" + msgpack.packb(sorted(value.items()))
+
+    @property
+    def full(self):
+        return len(self.values) >= self.max_size
+
+    def observe(self, key):
+        """
+        记录值出现的次数，返回是否应该放进字典表
+        """
+        if self.full or key in self.ids:
+            return False
+
+        count = self._seen.get(key, 0) + 1
+        if count < self.threshold:
+            # 避免只出现一次的值太多占用内存
+            if len(self._seen) >= self.max_size:
+                self._seen.clear()
+            self._seen[key] = count
+            return False
+
+        self._seen.pop(key, None)
+        return True
+
+    def add(self, _id, key, value):
+        self.ids[key] = _id
+        self.values[_id] = value
+
+    def get_id(self, value):
+        key = self.key(value)
+        _id = self.ids.get(key)
+        if _id is None and self.auto and self.observe(key):
+            _id = next(self._counter)
+            self.add(_id, key, value)
+        return _id
+
+    def lookup(self, _id):
+        try:
+            value = self.values[_id]
+        except KeyError:
+            raise UnknownInternId(_id)
+        # 请求头是字典，返回副本，避免修改request时修改字典表
+        return dict(value) if isinstance(value, dict) else value
+
+
+class RedisInternTable(InternTable):
+    """
+    保存在redis的字典表：<key>保存 编号 -> 值，<key>:ids保存 规范化的值 -> 编号。
+    值第一次出现就分配编号，同一个request的序列化结果不会因为后来放进字典表而改变
+    """
+    lua = """
+        local values_key = KEYS[1]
+        local ids_key = KEYS[2]
+        local result = {}
+        for i = 1, table.getn(ARGV), 2 do
+            local id = redis.call('hget', ids_key, ARGV[i])
+            if not id then
+                id = redis.call('hlen', values_key) + 1
+                redis.call('hset', values_key, id, ARGV[i + 1])
+                redis.call('hset', ids_key, ARGV[i], id)
+            end
+            table.insert(result, tonumber(id))
+        end
+        return result
+    """
+
+    def __init__(self, pool, key, max_size=10000):
+        super().__init__(max_size, auto=False, threshold=1)
+        self.pool = pool
+        self.scripts = ScriptRegistry(pool)
+        self.scripts.register("intern", self.lua)
+        self._values_key = key
+        self._ids_key = f"{key}:ids"
+
+    async def prepare(self, values):
+        """
+        给还没有编号的值分配编号，值第一次出现就分配（threshold为1），字典表满了之后不再分配，在序列化之前调用
+        """
+        new_values = {}
+        for value in values:
+            key = self.key(value)
+            if key not in new_values and self.observe(key):
+                new_values[key] = value
+        if not new_values:
+            return
+
+        args = []
+        for key, value in new_values.items():
+            args.extend((key, msgpack.packb(value)))
+        ids = await self.scripts.call("intern", (self._values_key, self._ids_key), args)
+        for _id, (key, value) in zip(ids, new_values.items()):
+            self.add(int(_id), key, value)
+
+    async def sync(self):
+        """
+        从redis加载字典表，反序列化遇到未知编号时调用
+        """
+        values = await self.pool.hgetall(self._values_key)
+        for _id, packed in values.items():
+            value = msgpack.unpackb(packed, strict_map_key=False)
+            self.add(int(_id), self.key(value), value)
+
+
+class WireSerializer:
+    """
+    序列化模块的接口：dumps、loads
+    """
+
+    def __init__(self, table: InternTable):
+        self.table = table
+        self._plans = {}
+
+    def _ref(self, value):
+        _id = self.table.get_id(value)
+        if _id is None:
+            return value
+        return msgpack.ExtType(EXT_REF, msgpack.packb(_id))
+
+    def _ext_hook(self, code, data):
+        if code == EXT_REF:
+            return self.table.lookup(msgpack.unpackb(data))
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, data):
+        http_kwargs = dict(data.get("http_kwargs") or {})
+        mask = 0
+        values = []
+        for index, name in enumerate(FIELDS):
+            value = http_kwargs.pop(name) if name in HTTP_KWARGS_FIELDS else data.get(name, DEFAULTS[name])
+            if value == DEFAULTS[name] and type(value) is type(DEFAULTS[name]):
+                continue
+            if value and name in INTERN_FIELDS:
+                value = self._ref(value)
+            mask |= 1 << index
+            values.append(value)
+
+        if http_kwargs:
+            mask |= 1 << EXTRA_BIT
+            values.append(http_kwargs)
+
+        url = data["url"]
+        origin, rest = split_origin(url)
+        if origin:
+            _id = self.table.get_id(origin)
+            if _id is not None:
+                url = [_id, rest]
+
+        return msgpack.packb([VERSION, url, mask, *values])
+
+    def loads(self, data):
+        packed = msgpack.unpackb(data, ext_hook=self._ext_hook, strict_map_key=False)
+        if packed[0] != VERSION:
+            raise ValueError(f"unsupported wire format version: {packed[0]}")
+
+        _, url, mask, *values = packed
+        if isinstance(url, list):
+            url = self.table.lookup(url[0]) + url[1]
+
+        result = dict(TOP_DEFAULTS, url=url)
+        http_kwargs = dict(HTTP_KWARGS_DEFAULTS)
+        for (name, is_http_kwargs), value in zip(self._get_plan(mask), values):
+            if is_http_kwargs:
+                http_kwargs[name] = value
+            else:
+                result[name] = value
+
+        if mask & (1 << EXTRA_BIT):
+            http_kwargs.update(values[-1])
+        result["http_kwargs"] = http_kwargs
+        return result
+
+    def _get_plan(self, mask):
+        """
+        位掩码对应的字段列表，每种位掩码只计算一次
+        """
+        plan = self._plans.get(mask)
+        if plan is None:
+            plan = tuple((name, name in HTTP_KWARGS_FIELDS) for index, name in enumerate(FIELDS) if mask & (1 << index))
+            self._plans[mask] = plan
+        return plan
+
+    @staticmethod
+    def intern_values(requests):
+        """
+        request中需要放进字典表的值
+        """
+        for request in requests:
+            if request.callback:
+                yield request.callback
+            if request.headers:
+                yield request.headers
+            origin, _ = split_origin(request.url)
+            if origin:
+                yield origin
+
+    async def prepare(self, requests):
+        if isinstance(self.table, RedisInternTable):
+            await self.table.prepare(self.intern_values(requests))
+
+    async def sync(self):
+        if isinstance(self.table, RedisInternTable):
+            await self.table.sync()
+
+
+# 没有使用redis时不使用字典表：序列化结果可能由其他进程反序列化（rabbitmq队列、hoopa run -p N、重启后的进程），
+# 只按位置存放字段、省略默认值
+default_serializer = WireSerializer(InternTable(auto=False))
+
+
+def dumps(data):
+    return default_serializer.dumps(data)
+
+
+def loads(data):
+    return default_serializer.loads(data)
+
+
+def bind_redis(pool, key):
+    """
+    创建字典表保存在redis的序列化器，RedisQueue调用
+    @param pool: redis连接，需要decode_responses=False
+    @param key: 字典表的key
+    """
+    return WireSerializer(RedisInternTable(pool, key))
@@ -74,7 +74,8 @@ setup(
         "Topic :: Software Development :: Libraries :: Application Frameworks",
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
-    extras_require={"uvloop": ["uvloop"]},
+    extras_require={"uvloop": ["uvloop"], "msgpack": ["msgpack>=1.0.0"], "mq": ["aio-pika>=8.0.0"],
+                    "zstd": ["zstandard"]},
     entry_points={"console_scripts": ["hoopa = hoopa.commands.cmdline:execute"]},
     include_package_data=True
 )
@@ -0,0 +1,43 @@
+# encoding: utf-8
+import asyncio
+from types import SimpleNamespace
+
+from hoopa.core.executor import TaskExecutor
+from hoopa.core.slot import SlotManager
+from hoopa.downloadermiddlewares.autothrottle import AutoThrottleMiddleware
+from hoopa.request import Request
+from hoopa.response import Response
+
+
+def make_middleware(limit):
+    engine = SimpleNamespace(
+        setting={"DOMAIN_DELAY": 0},
+        spider=SimpleNamespace(worker_numbers=10),
+        scheduler=SimpleNamespace(slots=SlotManager()),
+        executor=TaskExecutor(limit),
+    )
+    return AutoThrottleMiddleware(engine, enabled=True, error_threshold=0.1)
+
+
+def test_high_error_rate_holds_back_recovery():
+    async def main():
+        middleware = make_middleware(limit=2)
+        request = Request("https://example.com/")
+        slot = await middleware.engine.scheduler.slots.get_slot(request)
+        slot.delay = 1
+        middleware.error_rate = 0.5
+
+        for _ in range(3):
+            await middleware.process_response(request, Response(status=200, elapsed=0.1), None)
+        # 错误率还高于阈值，正常响应不减小请求间隔、不增加并发数
+        assert middleware.error_rate > 0.1
+        assert slot.delay == 1
+        assert middleware.engine.executor.limit == 2
+
+        for _ in range(10):
+            await middleware.process_response(request, Response(status=200, elapsed=0.1), None)
+        assert middleware.error_rate <= 0.1
+        assert slot.delay < 1
+        assert middleware.engine.executor.limit > 2
+
+    asyncio.run(main())
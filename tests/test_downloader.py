@@ -0,0 +1,115 @@
+# encoding: utf-8
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from hoopa.downloader import HttpxDownloader, RequestsDownloader
+from hoopa.request import Request
+from hoopa.utils.concurrency import run_function
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(0.3)
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def urls():
+    servers = []
+    for _ in range(3):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    yield [f"http://127.0.0.1:{server.server_port}" for server in servers]
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def url(urls):
+    return urls[0]
+
+
+async def create_downloader():
+    engine = SimpleNamespace(setting={"HTTP_CLIENT_KWARGS": None, "SHUTDOWN_TIMEOUT": None},
+                             spider=SimpleNamespace(worker_numbers=2))
+    downloader = await RequestsDownloader.create(engine)
+    await run_function(downloader.init)
+    return downloader
+
+
+def test_requests_close_waits_for_running_download(url):
+    async def main():
+        downloader = await create_downloader()
+        task = asyncio.ensure_future(downloader.fetch(Request(f"{url}/slow")))
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        await run_function(downloader.close)
+        # 等正在下载的请求完成后才关闭session
+        assert time.perf_counter() - start > 0.1
+        response = await task
+        assert response.status == 200
+        assert response.body == b"ok"
+
+    asyncio.run(main())
+
+
+def test_requests_stream_kwarg(url):
+    async def main():
+        downloader = await create_downloader()
+        try:
+            response = await downloader.fetch(Request(f"{url}/", stream=False))
+            assert response.status == 200
+        finally:
+            await run_function(downloader.close)
+
+    asyncio.run(main())
+
+
+class Stats:
+    def __init__(self):
+        self.values = {}
+
+    async def inc_value(self, key, count=1):
+        self.values[key] = self.values.get(key, 0) + count
+
+    async def max_value(self, key, value):
+        self.values[key] = max(self.values.get(key, value), value)
+
+
+def test_httpx_origin_stats_bounded(urls):
+    async def main():
+        setting = {"HTTP_CLIENT_KWARGS": None, "CONNECTION_STATS_INTERVAL": 5, "CONNECTION_STATS_ORIGINS": 2,
+                   "HTTPX_HTTP2": False}
+        engine = SimpleNamespace(setting=setting, stats=Stats())
+        downloader = await HttpxDownloader.create(engine)
+        await downloader.init()
+        try:
+            for url in urls * 2:
+                response = await downloader.fetch(Request(f"{url}/"))
+                assert response.status == 200
+            # 没有进行中请求的origin超过上限后删除
+            assert len(downloader._origins) <= 2
+            assert all(not state.active for state in downloader._origins.values())
+            prefix = "downloader/origins/"
+            origins = {key[len(prefix):].rsplit("/", 1)[0] for key in engine.stats.values if key.startswith(prefix)}
+            assert len(origins) == 3
+            assert "other" in origins
+        finally:
+            await downloader.close()
+
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+# encoding: utf-8
+import asyncio
+from types import SimpleNamespace
+
+from hoopa.core.engine import Engine
+from hoopa.core.spidermiddleware import SpiderMiddleware
+from hoopa.request import Request
+from hoopa.response import Response
+from hoopa.spidermiddlewares.handle_parse_error import HandleParseErrorMiddleware
+
+
+class Scheduler:
+    def __init__(self):
+        self.requests = []
+
+    async def add(self, requests):
+        self.requests.extend(requests)
+        return len(requests)
+
+
+class PipelineManager:
+    def __init__(self):
+        self.items = []
+
+    async def process_pipelines(self, request, response, item, spider):
+        self.items.append(item)
+
+
+def make_engine():
+    engine = Engine.__new__(Engine)
+    engine.spider = SimpleNamespace(push_number=1)
+    engine.scheduler = Scheduler()
+    engine.pipeline_manager = PipelineManager()
+    engine.spider_middleware = SpiderMiddleware([HandleParseErrorMiddleware()])
+    return engine
+
+
+def run_callback(engine, parse):
+    async def main():
+        request = Request("https://example.com/", callback=parse)
+        response = Response(ok=1)
+        results = await engine.spider_middleware.scrape_response(parse, request, response, engine.spider)
+        await engine._process_async_callback(request, response, results)
+        return response
+
+    return asyncio.run(main())
+
+
+def test_callback_error_after_output_not_retried():
+    async def parse(request, response):
+        yield {"page": 1}
+        yield Request("https://example.com/2")
+        raise ValueError("parse error")
+
+    engine = make_engine()
+    response = run_callback(engine, parse)
+    # 已经输出的结果保留，不重试，避免重复处理
+    assert response.ok == -1
+    assert engine.pipeline_manager.items == [{"page": 1}]
+    assert [request.url for request in engine.scheduler.requests] == ["https://example.com/2"]
+
+
+def test_callback_error_before_output_retried():
+    async def parse(request, response):
+        raise ValueError("parse error")
+        yield {"page": 1}
+
+    engine = make_engine()
+    response = run_callback(engine, parse)
+    assert response.ok == 0
+    assert engine.pipeline_manager.items == []
+
+
+def test_response_released_when_retried():
+    response = Response(ok=0, body=b'{"page": 1}', headers={})
+
+    async def handle_download_callback(request):
+        assert response.json() == {"page": 1}
+        return response
+
+    async def retry(request, response):
+        return True
+
+    async def release(request):
+        pass
+
+    engine = make_engine()
+    engine.handle_download_callback = handle_download_callback
+    engine._retry = retry
+    engine.scheduler.release = release
+    asyncio.run(engine._process_task(Request("https://example.com/")))
+    # 重试时也释放缓存的解析结果
+    assert response._json is None
+
+
+def test_error_recorded_as_failure():
+    results = []
+
+    async def handle_download_callback(request):
+        raise RuntimeError("download error")
+
+    async def set_result(request, response):
+        results.append(response.ok)
+
+    async def release(request):
+        pass
+
+    engine = make_engine()
+    engine.spider.process_failed = lambda request, response: None
+    engine.handle_download_callback = handle_download_callback
+    engine.scheduler.set_result = set_result
+    engine.scheduler.release = release
+    asyncio.run(engine._process_task(Request("https://example.com/")))
+    # 出错的request记录为失败，否则一直留在pending，爬虫不会结束
+    assert results == [-1]
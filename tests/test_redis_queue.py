@@ -0,0 +1,127 @@
+# encoding: utf-8
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+import hoopa.queues
+from hoopa.core.scheduler import Scheduler
+from hoopa.queues import RedisQueue
+from hoopa.request import Request
+from hoopa.response import Response
+
+
+class FakeRedis(fakeredis.FakeAsyncRedis):
+    async def script_load(self, script):
+        # fakeredis不支持redis.replicate_commands()
+        return await super().script_load(script.replace("redis.replicate_commands()", ""))
+
+
+class Stats:
+    async def inc_value(self, key, count=1):
+        pass
+
+
+class Engine:
+    requests_count = 0
+
+    def __init__(self, name):
+        self.setting = {"REDIS_SETTING": "redis://127.0.0.1:6379/0", "NAME": name, "SERIALIZATION": "ujson",
+                        "PENDING_THRESHOLD": 100}
+
+
+@pytest.fixture
+def run(monkeypatch):
+    server = fakeredis.FakeServer()
+
+    async def get_aio_redis(redis_setting, decode_responses=True):
+        return FakeRedis(server=server, decode_responses=decode_responses)
+
+    monkeypatch.setattr(hoopa.queues, "get_aio_redis", get_aio_redis)
+
+    def run(test):
+        async def main():
+            queue = await RedisQueue.create(Engine("test"))
+            await queue.init()
+            try:
+                await test(queue)
+            finally:
+                await queue.close()
+
+        asyncio.run(main())
+
+    return run
+
+
+def test_get_many_skips_corrupt_payload(run):
+    async def test(queue):
+        requests = [Request(f"https://example.com/{i}", priority=i) for i in range(3)]
+        await queue.add(requests)
+        # 破坏中间一个request的数据
+        bad_id = queue._request_id(requests[1].serialize(queue.serialization_module))
+        await queue.pool.hset(queue._requests_key, bad_id, b"\x00{not json")
+
+        got = await queue.get_many(3, None)
+        assert [request.url for request in got] == ["https://example.com/2", "https://example.com/0"]
+        assert await queue.pool.zscore(queue._pending_key, bad_id) is None
+        assert await queue.pool.hexists(queue._failure_key, bad_id)
+        assert await queue.pool.zcard(queue._pending_key) == 2
+
+        # 失败队列中无法反序列化的request不会放回waiting
+        await queue.failure_to_waiting(None)
+        assert await queue.pool.hexists(queue._failure_key, bad_id)
+        assert await queue.pool.zcard(queue._waiting_key) == 0
+
+    run(test)
+
+
+def test_completed_request_keeps_payload_while_delayed(run):
+    async def test(queue):
+        # retried是重试一次后的first，两者序列化结果相同，使用同一个id
+        retried = Request("https://example.com/1", retries=1)
+        first = Request("https://example.com/1")
+        await queue.add([retried, first])
+        got = {request.retries: request for request in await queue.get_many(2, None)}
+
+        got[0].retries += 1
+        await queue.retry(got[0], 0)
+        await queue.set_result(got[1], Response(ok=1))
+
+        request_id = queue._request_id(retried.serialize(queue.serialization_module))
+        assert await queue.pool.hexists(queue._requests_key, request_id)
+
+        queue._last_promote_time = 0
+        got = await queue.get_many(1, None)
+        assert [(request.url, request.retries) for request in got] == [("https://example.com/1", 1)]
+
+    run(test)
+
+
+def test_parked_request_outlives_lease(run):
+    async def test(queue):
+        queue.engine.setting.update({"PENDING_THRESHOLD": 2, "DOMAIN_DELAY": 60})
+        scheduler = Scheduler(scheduler_queue=queue, stats=Stats(), engine=queue.engine)
+        await queue.add([Request(f"https://example.com/{i}") for i in range(2)])
+
+        # 第一个request分发，第二个在slot中等待请求间隔
+        first = await scheduler.get(count=2)
+        await scheduler.set_result(first, Response(ok=1))
+        assert await scheduler.get(count=2) is None
+        assert scheduler.slots.parked == 1
+
+        # 等待超过租约时间，期间consumer等待唤醒时续租
+        deadline = time.time() + 3.5
+        while time.time() < deadline:
+            await scheduler.wait(0.2)
+
+        queue._last_check_pending_task_time = 0
+        await queue.check_pending_task()
+        parked = next(scheduler.slots.parked_requests())
+        parked_id = queue._request_id(parked.snapshot(queue.serialization_module))
+        assert await queue.pool.zscore(queue._pending_key, parked_id) is not None
+        assert await queue.pool.zcard(queue._waiting_key) == 0
+
+    run(test)
@@ -0,0 +1,21 @@
+# encoding: utf-8
+from hoopa.request import Request
+
+
+def test_fingerprint_after_in_place_change():
+    request = Request("https://example.com/list", params={"page": 1}, json={"ids": [1]})
+    fp = request.fp
+
+    request.params["page"] = 2
+    assert request.fp != fp
+    assert request.fp == Request("https://example.com/list", params={"page": 2}, json={"ids": [1]}).fp
+
+    fp = request.fp
+    request.json["ids"].append(2)
+    assert request.fp != fp
+
+
+def test_fingerprint_cached():
+    request = Request("https://example.com/list", params={"page": 1})
+    fp_bytes = request.fp_bytes
+    assert request.fp_bytes is fp_bytes
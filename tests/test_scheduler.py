@@ -0,0 +1,45 @@
+# encoding: utf-8
+import asyncio
+
+import hoopa.request
+from hoopa.core.scheduler import Scheduler
+from hoopa.dupefilters import MemoryDupeFilter
+from hoopa.request import Request
+
+
+class Queue:
+    def __init__(self):
+        self.data = []
+
+    async def add(self, requests):
+        # 和真实队列一样序列化request
+        self.data.extend(request.serialize() for request in requests)
+        return len(requests)
+
+
+class Stats:
+    async def inc_value(self, key, count=1):
+        pass
+
+
+def test_add_computes_fingerprint_once(monkeypatch):
+    calls = []
+    request_fingerprint = hoopa.request.helpers.request_fingerprint
+
+    def counted(request):
+        calls.append(request)
+        return request_fingerprint(request)
+
+    monkeypatch.setattr(hoopa.request.helpers, "request_fingerprint", counted)
+
+    async def main():
+        scheduler = Scheduler(MemoryDupeFilter(), Queue(), Stats())
+        requests = [Request("https://example.com/", method="post", params={"page": i}, json={"id": i})
+                    for i in range(10)]
+        assert await scheduler.add(requests) == 10
+        assert len(calls) == 10
+        # 已经加入去重器
+        assert await scheduler.add([Request("https://example.com/", method="post", params={"page": 1},
+                                            json={"id": 1})]) == 0
+
+    asyncio.run(main())
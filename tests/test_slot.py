@@ -0,0 +1,20 @@
+# encoding: utf-8
+import asyncio
+
+from hoopa.core.slot import SlotManager
+from hoopa.request import Request
+
+
+def test_slot_token_kept_when_priority_bucket_empty():
+    async def main():
+        slots = SlotManager(rate=1, burst=1, priority_rates={1: 1})
+        request = Request("https://example.com/1", priority=1)
+        slot = await slots.get_slot(request)
+        priority_bucket = slots.get_priority_bucket(1)
+        await priority_bucket.consume()
+
+        assert not await slots.is_ready(request)
+        # 优先级令牌桶没有令牌时，域名令牌桶的令牌不消耗
+        assert await slot.bucket.wait_time() == 0
+
+    asyncio.run(main())
@@ -0,0 +1,33 @@
+# encoding: utf-8
+import pytest
+
+pytest.importorskip("msgpack")
+
+from hoopa.request import Request
+from hoopa.utils import wire
+from hoopa.utils.wire import InternTable, WireSerializer
+
+
+def make_requests(user_agent="hoopa"):
+    headers = {"User-Agent": user_agent}
+    return [
+        Request(f"https://example.com/item/{i}", headers=headers, callback="parse", meta={"page": i}, priority=i % 3)
+        for i in range(5)
+    ]
+
+
+def test_decode_in_fresh_serializer():
+    # 模拟另一个进程或者重启后的进程：用新的序列化器反序列化
+    encoded = [request.serialize(wire) for request in make_requests()]
+
+    fresh = WireSerializer(InternTable(auto=False))
+    for request, data in zip(make_requests(), encoded):
+        decoded = Request.unserialize(data, fresh)
+        assert decoded.to_dict() == request.to_dict()
+
+
+def test_serialize_is_stable():
+    # 同一个request多次序列化的结果相同，不会因为值重复出现而改变
+    first = [request.serialize(wire) for request in make_requests("stable")]
+    second = [request.serialize(wire) for request in make_requests("stable")]
+    assert first == second